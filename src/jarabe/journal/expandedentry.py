@@ -16,15 +16,12 @@
 
 import logging
 from gettext import gettext as _
-import StringIO
 import time
 import os
 
-import cairo
 from gi.repository import GObject
 import glib
 from gi.repository import Gtk
-from gi.repository import Gdk
 import simplejson
 
 from sugar3.graphics import style
@@ -36,6 +33,7 @@ from jarabe.journal.keepicon import KeepIcon
 from jarabe.journal.palettes import ObjectPalette, BuddyPalette
 from jarabe.journal import misc
 from jarabe.journal import model
+from jarabe.journal import previewcache
 
 
 class Separator(Gtk.VBox):
@@ -205,51 +203,10 @@ class ExpandedEntry(Gtk.EventBox):
         box = Gtk.EventBox()
         box.modify_bg(Gtk.StateType.NORMAL, style.COLOR_WHITE.get_gdk_color())
 
-        if len(self._metadata.get('preview', '')) > 4:
-            if self._metadata['preview'][1:4] == 'PNG':
-                preview_data = self._metadata['preview']
-            else:
-                # TODO: We are close to be able to drop this.
-                import base64
-                preview_data = base64.b64decode(
-                        self._metadata['preview'])
-
-            png_file = StringIO.StringIO(preview_data)
-            try:
-                # Load image and scale to dimensions
-                im = Gtk.Image()
-                surface = cairo.ImageSurface.create_from_png(png_file)
-                png_width = surface.get_width()
-                png_height = surface.get_height()
-
-                preview_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32,
-                                                     width, height)
-                cr = cairo.Context(preview_surface)
-
-                scale_w = width * 1.0 / png_width
-                scale_h = height * 1.0 / png_height
-                scale = min(scale_w, scale_h)
-
-                cr.scale(scale, scale)
-
-                cr.set_source_rgba(1, 1, 1, 0)
-                cr.set_operator(cairo.OPERATOR_SOURCE)
-                cr.paint()
-                cr.set_source_surface(surface)
-                cr.paint()
-
-                pixbuf_bg = Gdk.pixbuf_get_from_surface(preview_surface, 0, 0,
-                                                        width, height)
-                im.set_from_pixbuf(pixbuf_bg)
-
-                has_preview = True
-            except Exception:
-                logging.exception('Error while loading the preview')
-                has_preview = False
-        else:
-            has_preview = False
-
-        if has_preview:
+        pixbuf = previewcache.get_pixbuf(self._metadata, width, height)
+        if pixbuf is not None:
+            im = Gtk.Image()
+            im.set_from_pixbuf(pixbuf)
             box.add(im)
             im.show()
         else:
@@ -270,9 +227,8 @@ class ExpandedEntry(Gtk.EventBox):
         lines = [
             _('Kind: %s') % (self._metadata.get('mime_type') or _('Unknown'),),
             _('Date: %s') % (self._format_date(),),
-            _('Size: %s') % (format_size(int(self._metadata.get(
-                        'filesize',
-                        model.get_file_size(self._metadata['uid'])))))
+            _('Size: %s') % (format_size(model.get_file_size(
+                        self._metadata['uid'], self._metadata)))
             ]
 
         for line in lines:
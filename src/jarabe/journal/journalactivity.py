@@ -23,19 +23,20 @@ from gi.repository import Gtk
 from gi.repository import Gdk
 from gi.repository import GdkX11
 import dbus
-import statvfs
-import os
 
 from sugar3.graphics.window import Window
-from sugar3.graphics.alert import ErrorAlert
+from sugar3.graphics.alert import Alert, ErrorAlert
+from sugar3.graphics.icon import Icon
 
 from sugar3.bundle.bundle import ZipExtractException, RegistrationException
 from sugar3 import env
+from sugar3 import util
 from sugar3.activity import activityfactory
 from gi.repository import SugarExt
 
 
 from jarabe.model import bundleregistry
+from jarabe.model import volumestats
 from jarabe.journal.journaltoolbox import MainToolbox, DetailToolbox
 from jarabe.journal.listview import ListView
 from jarabe.journal.detailview import DetailView
@@ -148,8 +149,13 @@ class JournalActivity(JournalWindow):
         self.iconify()
 
         self._critical_space_alert = None
+        volumestats.get_model().connect('usage-changed',
+                                        self.__usage_changed_cb)
         self._check_available_space()
 
+        self._batch_copy = None
+        self._batch_copy_alert = None
+
     def __volume_error_cb(self, gobject, message, severity):
         alert = ErrorAlert(title=severity, msg=message)
         alert.connect('response', self.__alert_response_cb)
@@ -159,6 +165,64 @@ class JournalActivity(JournalWindow):
     def __alert_response_cb(self, alert, response_id):
         self.remove_alert(alert)
 
+    def __copy_entries_cb(self, toolbox, mount_point):
+        object_ids = self._list_view.get_object_ids()
+        if object_ids:
+            self.copy_entries(object_ids, mount_point)
+
+    def copy_entries(self, object_ids, mount_point):
+        """Copy entries to mount_point without blocking the Journal
+
+        If entries are already being copied to mount_point, these get
+        added to that copy.
+        """
+        if self._batch_copy is not None:
+            if self._batch_copy.mount_point == mount_point:
+                self._batch_copy.add(object_ids)
+                return
+            self.__volume_error_cb(None,
+                    _('Wait for the entries being copied to be done.'),
+                    _('Warning'))
+            return
+
+        self._batch_copy = model.BatchCopy(object_ids, mount_point)
+        self._batch_copy.progress.connect(self.__batch_copy_progress_cb)
+        self._batch_copy.finished.connect(self.__batch_copy_finished_cb)
+
+        self._batch_copy_alert = Alert()
+        self._batch_copy_alert.props.title = _('Copying entries')
+        self._batch_copy_alert.props.msg = \
+                _('%(copied)d of %(total)d entries copied') % \
+                {'copied': 0, 'total': len(object_ids)}
+        self._batch_copy_alert.add_button(Gtk.ResponseType.CANCEL, _('Stop'),
+                                          Icon(icon_name='dialog-cancel'))
+        self._batch_copy_alert.connect('response',
+                                       self.__batch_copy_alert_response_cb)
+        self.add_alert(self._batch_copy_alert)
+        self._batch_copy_alert.show()
+
+        self._batch_copy.start()
+
+    def __batch_copy_alert_response_cb(self, alert, response_id):
+        self._batch_copy.cancel()
+        alert.props.msg = _('Stopping...')
+
+    def __batch_copy_progress_cb(self, sender, **kwargs):
+        self._batch_copy_alert.props.msg = \
+                _('%(copied)d of %(total)d entries copied (%(size)s)') % \
+                {'copied': kwargs['copied'], 'total': kwargs['total'],
+                 'size': util.format_size(kwargs['bytes_copied'])}
+
+    def __batch_copy_finished_cb(self, sender, **kwargs):
+        self.remove_alert(self._batch_copy_alert)
+        self._batch_copy_alert = None
+        self._batch_copy = None
+
+        if kwargs['failed']:
+            self.__volume_error_cb(None,
+                    _('%(failed)d of %(total)d entries could not be copied.')
+                    % kwargs, _('Error'))
+
     def __realize_cb(self, window):
         xid = window.get_window().get_xid()
         SugarExt.wm_set_bundle_id(xid, _BUNDLE_ID)
@@ -171,7 +235,7 @@ class JournalActivity(JournalWindow):
         return False
 
     def _setup_main_view(self):
-        self._main_toolbox = MainToolbox()
+        self._main_toolbox = MainToolbox(show_copy_button=True)
         self._main_view = Gtk.VBox()
         self._main_view.set_can_focus(True)
 
@@ -190,9 +254,12 @@ class JournalActivity(JournalWindow):
         self._volumes_toolbar.connect('volume-changed',
                                       self.__volume_changed_cb)
         self._volumes_toolbar.connect('volume-error', self.__volume_error_cb)
+        self._volumes_toolbar.connect('volume-converted',
+                                      self.__volume_converted_cb)
         self._main_view.pack_start(self._volumes_toolbar, False, True, 0)
 
         self._main_toolbox.connect('query-changed', self._query_changed_cb)
+        self._main_toolbox.connect('copy-entries', self.__copy_entries_cb)
         self._main_toolbox.search_entry.connect('icon-press',
                                                 self.__search_icon_pressed_cb)
         self._main_toolbox.set_mount_point('/')
@@ -278,10 +345,13 @@ class JournalActivity(JournalWindow):
         logging.debug('Selected volume: %r.', mount_point)
         self._main_toolbox.set_mount_point(mount_point)
 
+    def __volume_converted_cb(self, volume_toolbar, mount_point):
+        if self._list_view.get_mount_point() == mount_point:
+            self._list_view.refresh()
+
     def __model_created_cb(self, sender, **kwargs):
         self._check_for_bundle(kwargs['object_id'])
-        self._main_toolbox.refresh_filters()
-        self._check_available_space()
+        volumestats.get_model().queue_update()
 
     def __model_updated_cb(self, sender, **kwargs):
         self._check_for_bundle(kwargs['object_id'])
@@ -290,7 +360,7 @@ class JournalActivity(JournalWindow):
                 kwargs['object_id'] == self._detail_view.props.metadata['uid']:
             self._detail_view.refresh()
 
-        self._check_available_space()
+        volumestats.get_model().queue_update()
 
     def __model_deleted_cb(self, sender, **kwargs):
         if self.canvas == self._secondary_view and \
@@ -304,16 +374,27 @@ class JournalActivity(JournalWindow):
         registry = bundleregistry.get_registry()
 
         metadata = model.get(object_id)
+        if not misc.is_bundle(metadata):
+            return
+
         if metadata.get('progress', '').isdigit():
             if int(metadata['progress']) < 100:
                 return
 
+        # Avoid copying the file out of the data store every time an
+        # entry with a bundle that was installed already gets updated
+        if misc.is_bundle_installed(metadata):
+            return
+
         bundle = misc.get_bundle(metadata)
         if bundle is None:
             return
 
         if registry.is_installed(bundle):
             logging.debug('_check_for_bundle bundle already installed')
+            if not misc.is_journal_bundle(metadata) and \
+                    misc.set_bundle_installed(metadata, bundle):
+                model.write(metadata, update_mtime=False)
             return
 
         if metadata['mime_type'] == JournalEntryBundle.MIME_TYPE:
@@ -327,13 +408,16 @@ class JournalActivity(JournalWindow):
                         bundle.get_path())
             return
 
-        try:
-            registry.install(bundle)
-        except (ZipExtractException, RegistrationException):
-            logging.exception('Could not install bundle %s', bundle.get_path())
+        installation = registry.install_async(bundle)
+        installation.connect('finished', self.__bundle_installed_cb, metadata)
+
+    def __bundle_installed_cb(self, installation, error, metadata):
+        if error is not None:
+            logging.error('Could not install bundle %s: %r',
+                          installation.bundle.get_path(), error)
             return
 
-        metadata['bundle_id'] = bundle.get_bundle_id()
+        misc.set_bundle_installed(metadata, installation.bundle)
         model.write(metadata)
 
     def __window_state_event_cb(self, window, event):
@@ -357,14 +441,17 @@ class JournalActivity(JournalWindow):
 
         if self._critical_space_alert:
             return
-        stat = os.statvfs(env.get_profile_path())
-        free_space = stat[statvfs.F_BSIZE] * stat[statvfs.F_BAVAIL]
-        if free_space < _SPACE_TRESHOLD:
+        usage = volumestats.get_model().get_usage()
+        if usage is not None and usage.free_space < _SPACE_TRESHOLD:
             self._critical_space_alert = ModalAlert()
             self._critical_space_alert.connect('destroy',
                                                self.__alert_closed_cb)
             self._critical_space_alert.show()
 
+    def __usage_changed_cb(self, stats, path):
+        if path == env.get_profile_path():
+            self._check_available_space()
+
     def __alert_closed_cb(self, data):
         self.show_main_view()
         self.reveal()
@@ -50,6 +50,11 @@ from jarabe.journal import journalwindow
 
 _AUTOSEARCH_TIMEOUT = 1000
 
+# Entries that get deleted might take the last use of an activity with
+# them. Wait for this long (in milliseconds) for more deletions before
+# asking the data store again for the activities in use.
+_ACTIVITIES_REFRESH_DELAY = 1000
+
 _ACTION_ANYTIME = 0
 _ACTION_TODAY = 1
 _ACTION_SINCE_YESTERDAY = 2
@@ -69,12 +74,16 @@ class MainToolbox(ToolbarBox):
     __gsignals__ = {
         'query-changed': (GObject.SignalFlags.RUN_FIRST, None,
                           ([object])),
+        'copy-entries': (GObject.SignalFlags.RUN_FIRST, None,
+                         ([str])),
         }
 
-    def __init__(self):
+    def __init__(self, show_copy_button=False):
         ToolbarBox.__init__(self)
 
         self._mount_point = None
+        self._copy_button = None
+        self._volume_monitor = None
 
         self.search_entry = iconentry.IconEntry()
         self.search_entry.set_icon_from_name(iconentry.ICON_ENTRY_PRIMARY,
@@ -113,6 +122,25 @@ class MainToolbox(ToolbarBox):
                                      self.__sort_changed_cb)
         self._sorting_button.show()
 
+        if show_copy_button:
+            client = GConf.Client.get_default()
+            color = XoColor(client.get_string('/desktop/sugar/user/color'))
+            self._copy_button = ToolButton()
+            icon = Icon(icon_name='edit-copy', xo_color=color)
+            self._copy_button.set_icon_widget(icon)
+            icon.show()
+            self._copy_button.set_tooltip(_('Copy all entries to'))
+            self._copy_button.connect('clicked',
+                                      self.__copy_button_clicked_cb)
+            self.toolbar.insert(self._copy_button, -1)
+            self._copy_button.show()
+
+            self._volume_monitor = Gio.VolumeMonitor.get()
+            self._mount_added_hid = self._volume_monitor.connect(
+                'mount-added', self.__mount_changed_cb)
+            self._mount_removed_hid = self._volume_monitor.connect(
+                'mount-removed', self.__mount_changed_cb)
+
         # TODO: enable it when the DS supports saving the buddies.
         #self._with_search_combo = self._get_with_search_combo()
         #tool_item = ToolComboBox(self._with_search_combo)
@@ -121,8 +149,42 @@ class MainToolbox(ToolbarBox):
 
         self._query = self._build_query()
 
+        # The activities of the entries in the data store, and the ones of
+        # them that are installed and listed in the "what" filter
+        self._activity_values = None
+        self._what_activities = []
+        self._refresh_activities_timeout = None
+
         self.refresh_filters()
 
+        registry = bundleregistry.get_registry()
+        self._bundle_added_hid = registry.connect('bundle-added',
+                                                  self.__bundle_added_cb)
+        self._bundle_removed_hid = registry.connect('bundle-removed',
+                                                    self.__bundle_removed_cb)
+
+        model.created.connect(self.__model_created_cb)
+        model.deleted.connect(self.__model_deleted_cb)
+
+        self.connect('destroy', self.__destroy_cb)
+
+    def __destroy_cb(self, widget):
+        registry = bundleregistry.get_registry()
+        registry.disconnect(self._bundle_added_hid)
+        registry.disconnect(self._bundle_removed_hid)
+
+        model.created.disconnect(self.__model_created_cb)
+        model.deleted.disconnect(self.__model_deleted_cb)
+
+        if self._refresh_activities_timeout is not None:
+            GObject.source_remove(self._refresh_activities_timeout)
+            self._refresh_activities_timeout = None
+
+        if self._volume_monitor is not None:
+            self._volume_monitor.disconnect(self._mount_added_hid)
+            self._volume_monitor.disconnect(self._mount_removed_hid)
+            self._volume_monitor = None
+
     def _get_when_search_combo(self):
         when_search = ComboBox()
         when_search.append_item(_ACTION_ANYTIME, _('Anytime'))
@@ -260,11 +322,59 @@ class MainToolbox(ToolbarBox):
 
     def set_mount_point(self, mount_point):
         self._mount_point = mount_point
+        self._refresh_copy_palette()
         new_query = self._build_query()
         if self._query != new_query:
             self._query = new_query
             self.emit('query-changed', self._query)
 
+    def __copy_button_clicked_cb(self, button):
+        button.palette.popup(immediate=True, state=Palette.SECONDARY)
+
+    def __mount_changed_cb(self, volume_monitor, mount):
+        self._refresh_copy_palette()
+
+    def _refresh_copy_palette(self):
+        if self._copy_button is None:
+            return
+
+        palette = self._copy_button.get_palette()
+
+        for menu_item in palette.menu.get_children():
+            palette.menu.remove(menu_item)
+            menu_item.destroy()
+
+        if self._mount_point != '/':
+            client = GConf.Client.get_default()
+            color = XoColor(client.get_string('/desktop/sugar/user/color'))
+            journal_menu = MenuItem(_('Journal'))
+            journal_menu.set_image(Icon(icon_name='activity-journal',
+                                        xo_color=color,
+                                        icon_size=Gtk.IconSize.MENU))
+            journal_menu.connect('activate', self.__copy_menu_activate_cb,
+                                 '/')
+            palette.menu.append(journal_menu)
+            journal_menu.show()
+
+        icon_theme = Gtk.IconTheme.get_default()
+        for mount in self._volume_monitor.get_mounts():
+            mount_point = mount.get_root().get_path()
+            if mount_point is None or mount_point == self._mount_point:
+                continue
+            volume_menu = MenuItem(mount.get_name())
+            for name in mount.get_icon().props.names:
+                if icon_theme.has_icon(name):
+                    volume_menu.set_image(Icon(icon_name=name,
+                                               icon_size=Gtk.IconSize.MENU))
+                    break
+            volume_menu.connect('activate', self.__copy_menu_activate_cb,
+                                mount_point)
+            palette.menu.append(volume_menu)
+            volume_menu.show()
+
+    def __copy_menu_activate_cb(self, menu_item, mount_point):
+        self.emit('copy-entries', mount_point)
+
     def set_what_filter(self, what_filter):
         combo_model = self._what_search_combo.get_model()
         what_filter_index = -1
@@ -307,7 +417,9 @@ class MainToolbox(ToolbarBox):
 
             self._what_search_combo.append_separator()
 
-            for service_name in model.get_unique_values('activity'):
+            self._activity_values = list(model.get_unique_values('activity'))
+            self._what_activities = []
+            for service_name in self._activity_values:
                 activity_info = registry.get_bundle(service_name)
                 if activity_info is None:
                     continue
@@ -316,30 +428,122 @@ class MainToolbox(ToolbarBox):
                     combo_model = self._what_search_combo.get_model()
                     current_value_index = len(combo_model)
 
-                # try activity-provided icon
-                if os.path.exists(activity_info.get_icon()):
-                    try:
-                        self._what_search_combo.append_item(service_name,
-                                activity_info.get_name(),
-                                file_name=activity_info.get_icon())
-                    except GObject.GError, exception:
-                        logging.warning('Falling back to default icon for'
-                                        ' "what" filter because %r (%r) has an'
-                                        ' invalid icon: %s',
-                                        activity_info.get_name(),
-                                        str(service_name), exception)
-                    else:
-                        continue
+                self._append_activity_item(activity_info)
+
+        finally:
+            self._what_search_combo.handler_unblock(
+                    self._what_combo_changed_sid)
 
-                # fall back to generic icon
+    def _append_activity_item(self, activity_info):
+        service_name = activity_info.get_bundle_id()
+        self._what_activities.append(service_name)
+
+        # try activity-provided icon
+        if os.path.exists(activity_info.get_icon()):
+            try:
                 self._what_search_combo.append_item(service_name,
                         activity_info.get_name(),
-                        icon_name='application-octet-stream')
+                        file_name=activity_info.get_icon())
+            except GObject.GError, exception:
+                logging.warning('Falling back to default icon for'
+                                ' "what" filter because %r (%r) has an'
+                                ' invalid icon: %s',
+                                activity_info.get_name(),
+                                str(service_name), exception)
+            else:
+                return
+
+        # fall back to generic icon
+        self._what_search_combo.append_item(service_name,
+                activity_info.get_name(),
+                icon_name='application-octet-stream')
+
+    def _update_activity_items(self):
+        """Bring the activities in the "what" filter up to date
+
+        Only the items of the activities that were added or removed are
+        touched, the rest of the combo is left as it is.
+        """
+        registry = bundleregistry.get_registry()
+        wanted = [service_name for service_name in self._activity_values
+                  if registry.get_bundle(service_name) is not None]
+        removed = set(self._what_activities) - set(wanted)
+        added = [service_name for service_name in wanted
+                 if service_name not in self._what_activities]
+        if not removed and not added:
+            return
 
+        current_value = self._what_search_combo.props.value
+
+        self._what_search_combo.handler_block(self._what_combo_changed_sid)
+        try:
+            if removed:
+                self._what_activities = [service_name for service_name in
+                                         self._what_activities
+                                         if service_name not in removed]
+                combo_model = self._what_search_combo.get_model()
+                iterator = combo_model.get_iter_first()
+                while iterator is not None:
+                    if combo_model[iterator][0] in removed:
+                        if not combo_model.remove(iterator):
+                            iterator = None
+                    else:
+                        iterator = combo_model.iter_next(iterator)
+
+            for service_name in added:
+                self._append_activity_item(registry.get_bundle(service_name))
+
+            if current_value in removed:
+                self._what_search_combo.set_active(0)
         finally:
             self._what_search_combo.handler_unblock(
                     self._what_combo_changed_sid)
 
+        if current_value in removed:
+            self._update_if_needed()
+
+    def __bundle_added_cb(self, registry, bundle):
+        if self._activity_values is not None:
+            self._update_activity_items()
+
+    def __bundle_removed_cb(self, registry, bundle):
+        if self._activity_values is not None:
+            self._update_activity_items()
+
+    def __model_created_cb(self, sender, **kwargs):
+        object_id = kwargs['object_id']
+        if self._activity_values is None or object_id.startswith('/'):
+            # Only entries in the data store are taken into account
+            return
+
+        def reply_cb(metadata):
+            activity = metadata.get('activity')
+            if self._activity_values is not None and activity and \
+                    activity not in self._activity_values:
+                self._activity_values.append(activity)
+                self._update_activity_items()
+
+        def error_cb(error):
+            logging.error('Could not get the activity of %r: %s', object_id,
+                          error)
+
+        model.get_properties_async(object_id, ['activity'], reply_cb,
+                                   error_cb)
+
+    def __model_deleted_cb(self, sender, **kwargs):
+        if kwargs['object_id'].startswith('/'):
+            return
+        if self._refresh_activities_timeout is not None:
+            GObject.source_remove(self._refresh_activities_timeout)
+        self._refresh_activities_timeout = GObject.timeout_add(
+                _ACTIVITIES_REFRESH_DELAY, self.__refresh_activities_cb)
+
+    def __refresh_activities_cb(self):
+        self._refresh_activities_timeout = None
+        self._activity_values = list(model.get_unique_values('activity'))
+        self._update_activity_items()
+        return False
+
     def __favorite_button_toggled_cb(self, favorite_button):
         self._update_if_needed()
 
@@ -408,7 +612,6 @@ class DetailToolbox(ToolbarBox):
         button.palette.popup(immediate=True, state=Palette.SECONDARY)
 
     def _duplicate_clicked_cb(self, button):
-        file_path = model.get_file(self._metadata['uid'])
         try:
             model.copy(self._metadata, '/')
         except IOError, e:
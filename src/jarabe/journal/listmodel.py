@@ -15,6 +15,7 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import logging
+from collections import OrderedDict
 
 import simplejson
 from gi.repository import GObject
@@ -71,14 +72,22 @@ class ListModel(GObject.GObject, Gtk.TreeModel, Gtk.TreeDragSource):
     }
 
     _PAGE_SIZE = 10
+    _ROW_CACHE_SIZE = 100
+
+    # Shown while the entry of a row is being fetched. Its empty uid tells
+    # the rows that can't be acted upon yet.
+    _PLACEHOLDER_ROW = ['', False, None, None, '', '', '', '', 100,
+                        None, None, None]
 
     def __init__(self, query):
         GObject.GObject.__init__(self)
 
-        self._last_requested_index = None
-        self._cached_row = None
+        # Rows that have been built already, by index and in LRU order
+        self._cached_rows = OrderedDict()
+        self._cached_indexes = {}
         self._result_set = model.find(query, ListModel._PAGE_SIZE)
         self._temp_drag_file_path = None
+        self._is_ready = False
 
         # HACK: The view will tell us that it is resizing so the model can
         # avoid hitting D-Bus and disk.
@@ -86,12 +95,121 @@ class ListModel(GObject.GObject, Gtk.TreeModel, Gtk.TreeDragSource):
 
         self._result_set.ready.connect(self.__result_set_ready_cb)
         self._result_set.progress.connect(self.__result_set_progress_cb)
+        self._result_set.inserted.connect(self.__result_set_inserted_cb)
+        self._result_set.fetched.connect(self.__result_set_fetched_cb)
+
+        model.created.connect(self.__model_created_cb)
+        model.updated.connect(self.__model_updated_cb)
+        model.deleted.connect(self.__model_deleted_cb)
 
     def __result_set_ready_cb(self, **kwargs):
-        self.emit('ready')
+        if not self._is_ready:
+            self._is_ready = True
+            self.emit('ready')
 
     def __result_set_progress_cb(self, **kwargs):
-        self.emit('progress')
+        if not self._is_ready:
+            self.emit('progress')
+
+    def __result_set_inserted_cb(self, **kwargs):
+        self.clear_cached_rows()
+
+        if not self._is_ready:
+            # Show the rows found so far, the rest will be inserted as the
+            # result set keeps growing.
+            self._is_ready = True
+            self.emit('ready')
+            return
+
+        path = Gtk.TreePath((kwargs['position'],))
+        self.row_inserted(path, self.get_iter(path))
+
+    def __result_set_fetched_cb(self, **kwargs):
+        # Replace the placeholders that might be shown for these rows
+        offset = kwargs['offset']
+        for index in xrange(offset, offset + kwargs['count']):
+            if index not in self._cached_rows:
+                path = Gtk.TreePath((index,))
+                self.row_changed(path, self.get_iter(path))
+
+    def __model_created_cb(self, sender, signal, object_id):
+        # Rows after the new one will move
+        self.clear_cached_rows()
+
+    def __model_updated_cb(self, sender, signal, object_id):
+        index = self._cached_indexes.pop(object_id, None)
+        if index is not None:
+            del self._cached_rows[index]
+
+    def __model_deleted_cb(self, sender, signal, object_id):
+        if object_id in self._cached_indexes:
+            # Rows after the deleted one will move
+            self.clear_cached_rows()
+
+    def clear_cached_rows(self):
+        """Forget the rows built so far, they'll be built again on demand"""
+        self._cached_rows.clear()
+        self._cached_indexes.clear()
+
+    def _cache_row(self, index, row):
+        self._cached_rows[index] = row
+        self._cached_indexes[row[ListModel.COLUMN_UID]] = index
+
+        if len(self._cached_rows) > ListModel._ROW_CACHE_SIZE:
+            index_, old_row = self._cached_rows.popitem(last=False)
+            self._cached_indexes.pop(old_row[ListModel.COLUMN_UID], None)
+
+    def remove_row(self, uid):
+        """Remove the row of the entry uid without running the query again
+
+        Returns False if the query needs to be run again instead.
+        """
+        position = self._result_set.remove_entry(uid)
+        if position is None:
+            return False
+        if position != -1:
+            self.clear_cached_rows()
+            self.row_deleted(Gtk.TreePath((position,)))
+        return True
+
+    def insert_row(self, metadata):
+        """Add a row for a new entry without running the query again
+
+        Returns False if the query needs to be run again instead.
+        """
+        position = self._result_set.insert_entry(metadata)
+        if position is None:
+            return False
+        if position != -1:
+            self.clear_cached_rows()
+            path = Gtk.TreePath((position,))
+            self.row_inserted(path, self.get_iter(path))
+        return True
+
+    def update_row(self, metadata):
+        """Update the row of an entry without running the query again
+
+        The row is moved if the entry sorts differently now. Returns False
+        if the query needs to be run again instead.
+        """
+        positions = self._result_set.update_entry(metadata)
+        if positions is None:
+            return False
+
+        old_position, new_position = positions
+        self.clear_cached_rows()
+        if old_position == new_position:
+            if new_position != -1:
+                path = Gtk.TreePath((new_position,))
+                self.row_changed(path, self.get_iter(path))
+            return True
+
+        if old_position != -1:
+            self.row_deleted(Gtk.TreePath((old_position,)))
+        if new_position != -1:
+            path = Gtk.TreePath((new_position,))
+            self.row_inserted(path, self.get_iter(path))
+        return True
 
     def setup(self):
         self._result_set.setup()
@@ -99,8 +217,16 @@ class ListModel(GObject.GObject, Gtk.TreeModel, Gtk.TreeDragSource):
     def stop(self):
         self._result_set.stop()
 
+    def get_object_ids(self):
+        """Return the ids of all the entries in the model"""
+        return self._result_set.get_object_ids()
+
     def get_metadata(self, path):
-        return model.get(self[path][ListModel.COLUMN_UID])
+        """Return the metadata of the row, None if still being fetched"""
+        uid = self[path][ListModel.COLUMN_UID]
+        if not uid:
+            return None
+        return model.get(uid)
 
     def do_get_n_columns(self):
         return len(ListModel._COLUMN_TYPES)
@@ -119,31 +245,35 @@ class ListModel(GObject.GObject, Gtk.TreeModel, Gtk.TreeDragSource):
             return None
 
         index = iterator.user_data
-        if index == self._last_requested_index:
-            return self._cached_row[column]
+        row = self._cached_rows.pop(index, None)
+        if row is not None:
+            # Move it to the end, as the most recently used row
+            self._cached_rows[index] = row
+            return row[column]
 
         if index >= self._result_set.length:
             return None
 
         self._result_set.seek(index)
         metadata = self._result_set.read()
+        if metadata is None:
+            return ListModel._PLACEHOLDER_ROW[column]
 
-        self._last_requested_index = index
-        self._cached_row = []
-        self._cached_row.append(metadata['uid'])
-        self._cached_row.append(metadata.get('keep', '0') == '1')
-        self._cached_row.append(misc.get_icon_name(metadata))
+        row = []
+        row.append(metadata['uid'])
+        row.append(metadata.get('keep', '0') == '1')
+        row.append(misc.get_icon_name(metadata))
 
         if misc.is_activity_bundle(metadata):
             xo_color = XoColor('%s,%s' % (style.COLOR_BUTTON_GREY.get_svg(),
                                           style.COLOR_TRANSPARENT.get_svg()))
         else:
             xo_color = misc.get_icon_color(metadata)
-        self._cached_row.append(xo_color)
+        row.append(xo_color)
 
         title = GObject.markup_escape_text(metadata.get('title',
                                            _('Untitled')))
-        self._cached_row.append('<b>%s</b>' % (title, ))
+        row.append('<b>%s</b>' % (title, ))
 
         try:
             timestamp = float(metadata.get('timestamp', 0))
@@ -151,27 +281,27 @@ class ListModel(GObject.GObject, Gtk.TreeModel, Gtk.TreeDragSource):
             timestamp_content = _('Unknown')
         else:
             timestamp_content = util.timestamp_to_elapsed_string(timestamp)
-        self._cached_row.append(timestamp_content)
+        row.append(timestamp_content)
 
         try:
             creation_time = float(metadata.get('creation_time'))
         except (TypeError, ValueError):
-            self._cached_row.append(_('Unknown'))
+            row.append(_('Unknown'))
         else:
-            self._cached_row.append(
+            row.append(
                 util.timestamp_to_elapsed_string(float(creation_time)))
 
         try:
             size = int(metadata.get('filesize'))
         except (TypeError, ValueError):
             size = None
-        self._cached_row.append(util.format_size(size))
+        row.append(util.format_size(size))
 
         try:
             progress = int(float(metadata.get('progress', 100)))
         except (TypeError, ValueError):
             progress = 100
-        self._cached_row.append(progress)
+        row.append(progress)
 
         buddies = []
         if metadata.get('buddies'):
@@ -194,12 +324,13 @@ class ListModel(GObject.GObject, Gtk.TreeModel, Gtk.TreeDragSource):
                     logging.warning('Malformed buddies for %r: %s',
                                     metadata['uid'], exception)
                 else:
-                    self._cached_row.append((nick, XoColor(color)))
+                    row.append((nick, XoColor(color)))
                     continue
 
-            self._cached_row.append(None)
+            row.append(None)
 
-        return self._cached_row[column]
+        self._cache_row(index, row)
+        return row[column]
 
     def do_iter_nth_child(self, parent_iter, n):
         return (False, None)
@@ -235,10 +366,16 @@ class ListModel(GObject.GObject, Gtk.TreeModel, Gtk.TreeDragSource):
     def do_iter_parent(self, iterator):
         return (False, Gtk.TreeIter())
 
+    def do_row_draggable(self, path):
+        return bool(self[path][ListModel.COLUMN_UID])
+
     def do_drag_data_get(self, path, selection):
         uid = self[path][ListModel.COLUMN_UID]
+        if not uid:
+            return False
         if selection.target == 'text/uri-list':
-            # Get hold of a reference so the temp file doesn't get deleted
+            # Drop targets get a copy of the file, which they can move or
+            # modify. Get hold of a reference so it doesn't get deleted.
             self._temp_drag_file_path = model.get_file(uid)
             logging.debug('putting %r in selection', self._temp_drag_file_path)
             selection.set(selection.target, 8, self._temp_drag_file_path)
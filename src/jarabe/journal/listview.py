@@ -15,6 +15,7 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import logging
+from collections import OrderedDict
 from gettext import gettext as _
 import time
 
@@ -38,6 +39,17 @@ from jarabe.journal import misc
 
 UPDATE_INTERVAL = 300
 
+# Changes to the entries are gathered for this long (in milliseconds) and
+# then applied all at once
+REFRESH_DELAY = 500
+
+# Beyond this many changes at once, running the query again is cheaper
+MAX_INCREMENTAL_CHANGES = 20
+
+_CHANGE_CREATED = 'created'
+_CHANGE_UPDATED = 'updated'
+_CHANGE_DELETED = 'deleted'
+
 
 class TreeView(Gtk.TreeView):
     __gtype_name__ = 'JournalTreeView'
@@ -110,7 +122,8 @@ class BaseListView(Gtk.Bin):
         # Auto-update stuff
         self._fully_obscured = True
         self._dirty = False
-        self._refresh_idle_handler = None
+        self._pending_changes = OrderedDict()
+        self._changes_timeout = None
         self._update_dates_timer = None
 
         model.created.connect(self.__model_created_cb)
@@ -119,15 +132,88 @@ class BaseListView(Gtk.Bin):
 
     def __model_created_cb(self, sender, signal, object_id):
         if self._is_new_item_visible(object_id):
-            self._set_dirty()
+            self._add_change(object_id, _CHANGE_CREATED)
 
     def __model_updated_cb(self, sender, signal, object_id):
         if self._is_new_item_visible(object_id):
-            self._set_dirty()
+            self._add_change(object_id, _CHANGE_UPDATED)
 
     def __model_deleted_cb(self, sender, signal, object_id):
         if self._is_new_item_visible(object_id):
+            self._add_change(object_id, _CHANGE_DELETED)
+
+    def _add_change(self, object_id, change):
+        """Schedule applying a change to the entry object_id
+
+        Changes to the same entry are merged, so an entry that gets
+        created and then updated is just created.
+        """
+        if self._fully_obscured:
             self._set_dirty()
+            return
+
+        previous = self._pending_changes.get(object_id)
+        if previous == _CHANGE_CREATED:
+            if change == _CHANGE_DELETED:
+                del self._pending_changes[object_id]
+            return
+        if previous == _CHANGE_DELETED and change == _CHANGE_CREATED:
+            change = _CHANGE_UPDATED
+        self._pending_changes[object_id] = change
+
+        if self._changes_timeout is None:
+            self._changes_timeout = GObject.timeout_add(
+                    REFRESH_DELAY, self.__changes_timeout_cb)
+
+    def __changes_timeout_cb(self):
+        self._changes_timeout = None
+        changes, self._pending_changes = self._pending_changes, OrderedDict()
+
+        if len(changes) > MAX_INCREMENTAL_CHANGES or \
+                not self._apply_changes(changes):
+            self.refresh()
+        return False
+
+    def _apply_changes(self, changes):
+        """Apply the changes to the rows of the current model
+
+        Returns False if that was not possible, and the query needs to be
+        run again.
+        """
+        if self._model is None:
+            return False
+
+        for object_id, change in changes.iteritems():
+            if change == _CHANGE_DELETED:
+                if not self._model.remove_row(object_id):
+                    return False
+                continue
+
+            try:
+                metadata = model.get(object_id)
+            except Exception:
+                logging.exception('Could not get the metadata of %r',
+                                  object_id)
+                return False
+
+            if change == _CHANGE_CREATED:
+                applied = self._model.insert_row(metadata)
+            else:
+                applied = self._model.update_row(metadata)
+            if not applied:
+                return False
+
+        if len(self._model) == 0:
+            self._show_empty_message()
+        else:
+            self._clear_message()
+        return True
+
+    def _cancel_changes(self):
+        self._pending_changes.clear()
+        if self._changes_timeout is not None:
+            GObject.source_remove(self._changes_timeout)
+            self._changes_timeout = None
 
     def _is_new_item_visible(self, object_id):
         """Check if the created item is part of the currently selected view"""
@@ -236,6 +322,7 @@ class BaseListView(Gtk.Bin):
     def __destroy_cb(self, widget):
         if self._model is not None:
             self._model.stop()
+        self._cancel_changes()
 
     def __buddies_set_data_cb(self, column, cell, tree_model,
                               tree_iter, data):
@@ -258,8 +345,9 @@ class BaseListView(Gtk.Bin):
             cell.props.xo_color = None
 
     def __favorite_clicked_cb(self, cell, path):
-        row = self._model[path]
-        metadata = model.get(row[ListModel.COLUMN_UID])
+        metadata = self._model.get_metadata(path)
+        if metadata is None:
+            return
         if not model.is_editable(metadata):
             return
         if metadata.get('keep', 0) == '1':
@@ -282,6 +370,15 @@ class BaseListView(Gtk.Bin):
 
         self.refresh()
 
+    def get_mount_point(self):
+        return self._query.get('mountpoints', [None])[0]
+
+    def get_object_ids(self):
+        """Return the ids of all the entries listed"""
+        if self._model is None:
+            return []
+        return self._model.get_object_ids()
+
     def refresh(self):
         logging.debug('ListView.refresh query %r', self._query)
         self._stop_progress_bar()
@@ -289,6 +386,8 @@ class BaseListView(Gtk.Bin):
         if self._model is not None:
             self._model.stop()
         self._dirty = False
+        # The new query will include all the pending changes
+        self._cancel_changes()
 
         self._model = ListModel(self._query)
         self._model.connect('ready', self.__model_ready_cb)
@@ -319,20 +418,23 @@ class BaseListView(Gtk.Bin):
             self.tree_view.get_bin_window().show()
 
         if len(tree_model) == 0:
-            if self._is_query_empty():
-                if self._query['mountpoints'] == ['/']:
-                    self._show_message(_('Your Journal is empty'))
-                elif self._query['mountpoints'] == \
-                        [model.get_documents_path()]:
-                    self._show_message(_('Your documents folder is empty'))
-                else:
-                    self._show_message(_('The device is empty'))
-            else:
-                self._show_message(_('No matching entries'),
-                                   show_clear_query=True)
+            self._show_empty_message()
         else:
             self._clear_message()
 
+    def _show_empty_message(self):
+        if self._is_query_empty():
+            if self._query['mountpoints'] == ['/']:
+                self._show_message(_('Your Journal is empty'))
+            elif self._query['mountpoints'] == \
+                    [model.get_documents_path()]:
+                self._show_message(_('Your documents folder is empty'))
+            else:
+                self._show_message(_('The device is empty'))
+        else:
+            self._show_message(_('No matching entries'),
+                               show_clear_query=True)
+
     def __map_cb(self, widget):
         logging.debug('ListView.__map_cb %r', self._scroll_position)
         self.tree_view.props.vadjustment.props.value = self._scroll_position
@@ -438,6 +540,8 @@ class BaseListView(Gtk.Bin):
 
         path, end_path = visible_range
         tree_model = self.tree_view.get_model()
+        # The cached rows contain the dates as text relative to now
+        tree_model.clear_cached_rows()
 
         while True:
             cel_rect = self.tree_view.get_cell_area(path,
@@ -455,6 +559,7 @@ class BaseListView(Gtk.Bin):
     def _set_dirty(self):
         if self._fully_obscured:
             self._dirty = True
+            self._cancel_changes()
         else:
             self.refresh()
 
@@ -540,8 +645,9 @@ class ListView(BaseListView):
         if column != self._title_column:
             return
 
-        row = self.tree_view.get_model()[path]
-        metadata = model.get(row[ListModel.COLUMN_UID])
+        metadata = self.tree_view.get_model().get_metadata(path)
+        if metadata is None:
+            return
         self.cell_title.props.editable = model.is_editable(metadata)
         if self.cell_title.props.editable:
             self.emit('title-edit-started')
@@ -551,7 +657,8 @@ class ListView(BaseListView):
 
     def __detail_cell_clicked_cb(self, cell, path):
         row = self.tree_view.get_model()[path]
-        self.emit('detail-clicked', row[ListModel.COLUMN_UID])
+        if row[ListModel.COLUMN_UID]:
+            self.emit('detail-clicked', row[ListModel.COLUMN_UID])
 
     def __detail_clicked_cb(self, cell, uid):
         self.emit('detail-clicked', uid)
@@ -560,15 +667,15 @@ class ListView(BaseListView):
         self.emit('volume-error', message, severity)
 
     def __icon_clicked_cb(self, cell, path):
-        row = self.tree_view.get_model()[path]
-        metadata = model.get(row[ListModel.COLUMN_UID])
-        misc.resume(metadata)
+        metadata = self.tree_view.get_model().get_metadata(path)
+        if metadata is not None:
+            misc.resume(metadata)
 
     def __cell_title_edited_cb(self, cell, path, new_text):
-        row = self._model[path]
-        metadata = model.get(row[ListModel.COLUMN_UID])
-        metadata['title'] = new_text
-        model.write(metadata, update_mtime=False)
+        metadata = self._model.get_metadata(path)
+        if metadata is not None:
+            metadata['title'] = new_text
+            model.write(metadata, update_mtime=False)
         self.cell_title.props.editable = False
         self.emit('title-edit-finished')
 
@@ -639,6 +746,8 @@ class CellRendererActivityIcon(CellRendererIcon):
 
         tree_model = self.tree_view.get_model()
         metadata = tree_model.get_metadata(self.props.palette_invoker.path)
+        if metadata is None:
+            return None
 
         palette = ObjectPalette(metadata, detail=True)
         palette.connect('detail-clicked',
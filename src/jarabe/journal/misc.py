@@ -17,6 +17,12 @@
 import logging
 import time
 import os
+import errno
+import hashlib
+import tempfile
+import zipfile
+import ConfigParser
+from StringIO import StringIO
 from gettext import gettext as _
 
 from gi.repository import Gio
@@ -32,7 +38,10 @@ from sugar3 import mime
 from sugar3.bundle.activitybundle import ActivityBundle
 from sugar3.bundle.bundle import AlreadyInstalledException
 from sugar3.bundle.contentbundle import ContentBundle
+from sugar3.bundle.bundleversion import NormalizedVersion
+from sugar3.bundle.bundleversion import InvalidVersionError
 from sugar3 import util
+from sugar3 import env
 
 from jarabe.view import launcher
 from jarabe.model import bundleregistry, shell
@@ -41,6 +50,20 @@ from jarabe.journal import model
 from jarabe.journal import journalwindow
 
 
+_BUNDLE_ICONS_DIR = 'bundle-icons'
+
+# Icons kept on disk, the ones used least recently are removed
+_BUNDLE_ICONS_DISK_CACHE_SIZE = 200
+
+# Icons written between checks of the size of the disk cache
+_BUNDLE_ICONS_PRUNE_INTERVAL = 20
+
+# Icons of bundles that are not installed, by key of the Journal entry.
+# None for the bundles the icon could not be read of.
+_bundle_icons = {}
+_icon_writes_since_prune = _BUNDLE_ICONS_PRUNE_INTERVAL
+
+
 def _get_icon_for_mime(mime_type):
     generic_types = mime.get_all_generic_types()
     for generic_type in generic_types:
@@ -70,13 +93,7 @@ def get_icon_name(metadata):
             file_name = activity_info.get_icon()
 
     if file_name is None and is_activity_bundle(metadata):
-        file_path = model.get_file(metadata['uid'])
-        if file_path is not None and os.path.exists(file_path):
-            try:
-                bundle = ActivityBundle(file_path)
-                file_name = bundle.get_icon()
-            except Exception:
-                logging.exception('Could not read bundle')
+        file_name = _get_bundle_icon(metadata)
 
     if file_name is None:
         file_name = _get_icon_for_mime(metadata.get('mime_type', ''))
@@ -87,6 +104,132 @@ def get_icon_name(metadata):
     return file_name
 
 
+def _get_bundle_icon_key(metadata):
+    """Return a key that changes whenever the bundle in the entry changes"""
+    checksum = metadata.get('checksum')
+    if not checksum:
+        checksum = '%s %s' % (metadata.get('timestamp', ''),
+                              metadata.get('filesize', ''))
+    return hashlib.sha1('%s %s' % (metadata['uid'], checksum)).hexdigest()
+
+
+def _get_bundle_icon(metadata):
+    """Return the icon of an activity bundle that is not installed
+
+    The icon is extracted only once and kept in the profile, so later
+    calls don't need to get the bundle out of the data store.
+    """
+    key = _get_bundle_icon_key(metadata)
+    if key in _bundle_icons:
+        return _bundle_icons[key]
+
+    icons_path = env.get_profile_path(_BUNDLE_ICONS_DIR)
+    icon_path = os.path.join(icons_path, key + '.svg')
+    if os.path.exists(icon_path):
+        try:
+            # Keep track of when it was used last, for pruning
+            os.utime(icon_path, None)
+        except OSError:
+            pass
+    else:
+        file_path = model.get_readonly_file(metadata['uid'])
+        if file_path is None or not os.path.exists(file_path):
+            _bundle_icons[key] = None
+            return None
+
+        icon_data = _read_bundle_icon(file_path)
+        if icon_data is None:
+            _bundle_icons[key] = None
+            return None
+
+        try:
+            if not os.path.exists(icons_path):
+                os.makedirs(icons_path)
+            fd, temp_path = tempfile.mkstemp(dir=icons_path)
+            os.write(fd, icon_data)
+            os.close(fd)
+            os.rename(temp_path, icon_path)
+        except EnvironmentError:
+            logging.exception('Could not store icon of bundle %r',
+                              metadata['uid'])
+            _bundle_icons[key] = None
+            return None
+        _icon_written(icons_path)
+
+    _bundle_icons[key] = icon_path
+    return icon_path
+
+
+def _icon_written(icons_path):
+    global _icon_writes_since_prune
+
+    _icon_writes_since_prune += 1
+    if _icon_writes_since_prune >= _BUNDLE_ICONS_PRUNE_INTERVAL:
+        _icon_writes_since_prune = 0
+        _prune_bundle_icons(icons_path)
+
+
+def _prune_bundle_icons(icons_path):
+    """Remove the icons used least recently beyond the cache size"""
+    entries = []
+    for name in os.listdir(icons_path):
+        path = os.path.join(icons_path, name)
+        try:
+            entries.append((os.stat(path).st_mtime, path))
+        except OSError:
+            continue
+
+    entries.sort(reverse=True)
+    removed = set()
+    for mtime_, path in entries[_BUNDLE_ICONS_DISK_CACHE_SIZE:]:
+        try:
+            os.unlink(path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                logging.error('Could not remove cached icon %r: %s',
+                              path, e)
+                continue
+        removed.add(path)
+
+    for key, icon_path in _bundle_icons.items():
+        if icon_path in removed:
+            del _bundle_icons[key]
+
+
+def _read_bundle_icon(file_path):
+    """Read the SVG icon out of a zipped activity bundle
+
+    Only the zip directory and the members we need are read, there is no
+    need to validate or extract the whole bundle for this.
+    """
+    try:
+        bundle_zip = zipfile.ZipFile(file_path)
+    except (zipfile.BadZipfile, EnvironmentError):
+        logging.exception('Could not read bundle %r', file_path)
+        return None
+
+    try:
+        for name in bundle_zip.namelist():
+            parts = name.split('/')
+            if len(parts) == 3 and parts[1:] == ['activity', 'activity.info']:
+                root_dir = parts[0]
+                break
+        else:
+            logging.warning('No activity.info in bundle %r', file_path)
+            return None
+
+        info = ConfigParser.ConfigParser()
+        info.readfp(StringIO(bundle_zip.read(name)))
+        icon = info.get('Activity', 'icon')
+        return bundle_zip.read('%s/activity/%s.svg' % (root_dir, icon))
+    except (KeyError, ConfigParser.Error, zipfile.BadZipfile,
+            EnvironmentError):
+        logging.exception('Could not read icon of bundle %r', file_path)
+        return None
+    finally:
+        bundle_zip.close()
+
+
 def get_date(metadata):
     """ Convert from a string in iso format to a more human-like format. """
     if 'timestamp' in metadata:
@@ -137,15 +280,62 @@ def get_bundle(metadata):
         return None
 
 
+def get_bundle_checksum(metadata):
+    """Return what tells the bundle in the entry from other versions of it
+
+    The data store computes the checksum of the file some time after it
+    has been saved, until then the size has to do.
+    """
+    return metadata.get('checksum') or metadata.get('filesize') or None
+
+
+def is_bundle_installed(metadata):
+    """Whether the bundle in the entry is known to be installed
+
+    Only the metadata recorded by set_bundle_installed() is looked at, so
+    the file doesn't need to be copied out of the data store. False means
+    that the bundle itself has to be checked.
+    """
+    checksum = get_bundle_checksum(metadata)
+    if checksum is None or metadata.get('bundle_checksum') != checksum:
+        return False
+
+    if not is_activity_bundle(metadata):
+        # Only activities are kept in the registry
+        return True
+
+    registry = bundleregistry.get_registry()
+    installed_bundle = registry.get_bundle(metadata.get('bundle_id'))
+    if installed_bundle is None:
+        return False
+    try:
+        return NormalizedVersion(installed_bundle.get_activity_version()) >= \
+                NormalizedVersion(metadata.get('bundle_version', ''))
+    except InvalidVersionError:
+        return False
+
+
+def set_bundle_installed(metadata, bundle):
+    """Record in the metadata of the entry that its bundle is installed
+
+    Returns True if the metadata changed and needs to be written.
+    """
+    values = {'bundle_id': bundle.get_bundle_id(),
+              'bundle_checksum': get_bundle_checksum(metadata)}
+    if isinstance(bundle, ActivityBundle):
+        values['bundle_version'] = bundle.get_activity_version()
+
+    changed = False
+    for key, value in values.iteritems():
+        if value is not None and metadata.get(key) != str(value):
+            metadata[key] = str(value)
+            changed = True
+    return changed
+
+
 def _get_activities_for_mime(mime_type):
     registry = bundleregistry.get_registry()
-    result = registry.get_activities_for_type(mime_type)
-    if not result:
-        for parent_mime in mime.get_mime_parents(mime_type):
-            for activity in registry.get_activities_for_type(parent_mime):
-                if activity not in result:
-                    result.append(activity)
-    return result
+    return registry.get_activities_for_type_or_parents(mime_type)
 
 
 def get_activities(metadata):
@@ -179,10 +369,12 @@ def resume(metadata, bundle_id=None):
         if not registry.is_installed(bundle):
             logging.debug('Installing activity bundle')
             try:
-                registry.install(bundle)
+                installation = registry.install_async(bundle)
             except AlreadyInstalledException:
                 _downgrade_option_alert(bundle)
                 return
+            installation.connect('finished', _bundle_installed_cb)
+            return
         else:
             logging.debug('Upgrading activity bundle')
             registry.upgrade(bundle)
@@ -268,6 +460,14 @@ def launch(bundle, activity_id=None, object_id=None, uri=None, color=None,
     activityfactory.create(bundle, activity_handle)
 
 
+def _bundle_installed_cb(installation, error):
+    if error is not None:
+        logging.error('Could not install bundle %s: %r',
+                      installation.bundle.get_path(), error)
+        return
+    _launch_bundle(installation.bundle)
+
+
 def _downgrade_option_alert(bundle):
     alert = ConfirmationAlert()
     alert.props.title = _('Older Version Of %s Activity') % (bundle.get_name())
@@ -282,8 +482,8 @@ def _downgrade_alert_response_cb(alert, response_id, bundle):
     if response_id is Gtk.ResponseType.OK:
         journalwindow.get_journal_window().remove_alert(alert)
         registry = bundleregistry.get_registry()
-        registry.install(bundle, force_downgrade=True)
-        _launch_bundle(bundle)
+        installation = registry.install_async(bundle, force_downgrade=True)
+        installation.connect('finished', _bundle_installed_cb)
     elif response_id is Gtk.ResponseType.CANCEL:
         journalwindow.get_journal_window().remove_alert(alert)
 
@@ -23,8 +23,13 @@ import time
 import shutil
 import tempfile
 from stat import S_IFLNK, S_IFMT, S_IFDIR, S_IFREG
-import re
-from operator import itemgetter
+import bisect
+import functools
+from collections import deque, namedtuple
+import threading
+import Queue
+import ctypes
+import hashlib
 import simplejson
 from gettext import gettext as _
 
@@ -36,20 +41,57 @@ from gi.repository import GConf
 from sugar3 import dispatch
 from sugar3 import mime
 from sugar3 import util
+from sugar3 import env
 
+from jarabe.journal import volumeindex
 
 DS_DBUS_SERVICE = 'org.laptop.sugar.DataStore'
 DS_DBUS_INTERFACE = 'org.laptop.sugar.DataStore'
 DS_DBUS_PATH = '/org/laptop/sugar/DataStore'
 
 # Properties the journal cares about.
-PROPERTIES = ['activity', 'activity_id', 'buddies', 'bundle_id',
+PROPERTIES = ['activity', 'activity_id', 'buddies', 'bundle_id', 'checksum',
               'creation_time', 'filesize', 'icon-color', 'keep', 'mime_type',
               'mountpoint', 'mtime', 'progress', 'timestamp', 'title', 'uid']
 
+# Properties to ask for when only the number of entries, or their ids,
+# are needed. The data store returns every property when none are asked
+# for.
+_COUNT_PROPERTIES = ['uid']
+
 MIN_PAGES_TO_CACHE = 3
 MAX_PAGES_TO_CACHE = 5
 
+# Seconds of reading to look back at for estimating the scroll velocity
+_VELOCITY_WINDOW = 0.5
+# Seconds of reading at the current velocity to fetch ahead of time
+_PREFETCH_TIME = 1.0
+# Seconds between checks of the free memory, to size the caches
+_MEMORY_CHECK_INTERVAL = 10
+
+# Seconds a removable volume scan may run per main loop iteration
+_SCAN_TIME_SLICE = 0.008
+# Milliseconds between checks for results while the scan workers are busy
+_SCAN_POLL_INTERVAL = 20
+_DEFAULT_SCAN_WORKERS = 2
+# Seconds between batches of rows added while a volume is being scanned
+_SCAN_BATCH_INTERVAL = 0.25
+
+# Entries copied by BatchCopy before the data is flushed to the device
+_COPY_BATCH_SIZE = 50
+# Threads copying entries at once. Removable devices don't get any faster
+# with more writers, but reading the next entry overlaps with writing.
+_COPY_WORKERS = 2
+# How often (in milliseconds) BatchCopy checks on the copying threads
+_COPY_POLL_INTERVAL = 50
+# How often (in seconds) BatchCopy reports progress within a batch
+_COPY_PROGRESS_INTERVAL = 0.5
+# Flash media are much faster with large writes
+_COPY_BUFFER_SIZE = 1024 * 1024
+# Files being copied to a device are kept in its metadata directory, with
+# this suffix, until they are complete
+_PARTIAL_SUFFIX = '.part'
+
 JOURNAL_METADATA_DIR = '.Sugar-Metadata'
 
 _datastore = None
@@ -57,6 +99,17 @@ created = dispatch.Signal()
 updated = dispatch.Signal()
 deleted = dispatch.Signal()
 
+_FileInfo = namedtuple('_FileInfo', ['stat', 'mime_type', 'metadata',
+                                     'is_link', 'terms'])
+
+# Where the preview of an entry on a device is, for it to be read only
+# when needed. Kept in the metadata under _PREVIEW_HANDLE.
+_PreviewHandle = namedtuple('_PreviewHandle', ['path', 'size'])
+_PREVIEW_HANDLE = '_preview_handle'
+
+_max_pages_to_cache = MAX_PAGES_TO_CACHE
+_last_memory_check = 0
+
 
 class _Cache(object):
 
@@ -82,6 +135,9 @@ class _Cache(object):
     def __delitem__(self, key):
         del self._array[key]
 
+    def insert(self, index, entry):
+        self._array.insert(index, entry)
+
 
 class BaseResultSet(object):
     """Encapsulates the result of a query
@@ -96,8 +152,16 @@ class BaseResultSet(object):
         self._offset = 0
         self._cache = _Cache()
 
+        # Recent (time, position) reads, to estimate the scroll velocity
+        self._reads = deque()
+        self._prefetching = False
+
         self.ready = dispatch.Signal()
         self.progress = dispatch.Signal()
+        # Sent for result sets that grow while they are being set up
+        self.inserted = dispatch.Signal()
+        # Sent when entries that were not available on read() arrive
+        self.fetched = dispatch.Signal()
 
     def setup(self):
         self.ready.send(self)
@@ -107,18 +171,51 @@ class BaseResultSet(object):
 
     def get_length(self):
         if self._total_count == -1:
-            query = self._query.copy()
-            query['limit'] = self._page_size * MIN_PAGES_TO_CACHE
-            entries, self._total_count = self.find(query)
-            self._cache.append_all(entries)
-            self._offset = 0
+            self._total_count = self.count()
         return self._total_count
 
     length = property(get_length)
 
+    def count(self):
+        """Return the number of entries matching the query
+
+        Result sets that can count without reading the entries should
+        override this.
+        """
+        query = self._query.copy()
+        query['limit'] = 1
+        entries_, total_count = self.find(query)
+        return total_count
+
+    def get_object_ids(self):
+        """Return the ids of all the entries in the result set"""
+        query = self._query.copy()
+        query.pop('limit', None)
+        query.pop('offset', None)
+        entries, total_count_ = self.find(query)
+        return [entry['uid'] for entry in entries]
+
     def find(self, query):
         raise NotImplementedError()
 
+    def find_async(self, query, reply_handler, error_handler):
+        """Like find(), but the results are passed to reply_handler
+
+        Result sets that can query without blocking should override this,
+        by default find() gets called from the main loop.
+        """
+        GObject.idle_add(self.__find_idle_cb, query, reply_handler,
+                         error_handler)
+
+    def __find_idle_cb(self, query, reply_handler, error_handler):
+        try:
+            entries, total_count = self.find(query)
+        except Exception, e:
+            error_handler(e)
+        else:
+            reply_handler(entries, total_count)
+        return False
+
     def seek(self, position):
         self._position = position
 
@@ -169,12 +266,7 @@ class BaseResultSet(object):
             # update cache
             self._cache.append_all(entries)
 
-            # apply the cache limit
-            cache_limit = self._page_size * MAX_PAGES_TO_CACHE
-            objects_excess = len(self._cache) - cache_limit
-            if objects_excess > 0:
-                self._offset += objects_excess
-                del self._cache[:objects_excess]
+            self._apply_cache_limit(forward=True)
 
         elif remaining_forward_entries > 0 and \
                 remaining_backwards_entries <= 0 and self._offset > 0:
@@ -193,13 +285,226 @@ class BaseResultSet(object):
             # update cache
             self._cache.prepend_all(entries)
 
-            # apply the cache limit
-            cache_limit = self._page_size * MAX_PAGES_TO_CACHE
-            objects_excess = len(self._cache) - cache_limit
-            if objects_excess > 0:
-                del self._cache[-objects_excess:]
+            self._apply_cache_limit(forward=False)
 
-        return self._cache[self._position - self._offset]
+        entry = self._cache[self._position - self._offset]
+        self._prefetch()
+        return entry
+
+    def _apply_cache_limit(self, forward):
+        """Drop the entries farthest behind, in the direction of reading"""
+        cache_limit = self._page_size * _get_max_pages_to_cache()
+        objects_excess = len(self._cache) - cache_limit
+        if objects_excess <= 0:
+            return
+        if forward:
+            self._offset += objects_excess
+            del self._cache[:objects_excess]
+        else:
+            del self._cache[-objects_excess:]
+
+    def _prefetch(self):
+        """Fetch the pages the reader will need next before it gets there
+
+        The scroll velocity is estimated from the recent reads, and enough
+        pages to keep up with it for _PREFETCH_TIME are requested
+        asynchronously in the direction of scrolling.
+        """
+        now = time.time()
+        self._reads.append((now, self._position))
+        while now - self._reads[0][0] > _VELOCITY_WINDOW:
+            self._reads.popleft()
+
+        first_time, first_position = self._reads[0]
+        if self._prefetching or now == first_time or \
+                first_position == self._position:
+            return
+        velocity = (self._position - first_position) / (now - first_time)
+
+        max_pages = _get_max_pages_to_cache()
+        pages = int(abs(velocity) * _PREFETCH_TIME / self._page_size) + 1
+        # Leave room in the cache for the page being read
+        pages = min(pages, max(1, max_pages / 2))
+        distance = pages * self._page_size
+
+        cache_end = self._offset + len(self._cache)
+        if velocity > 0:
+            if cache_end - self._position > distance or \
+                    cache_end >= self._total_count:
+                return
+            offset = cache_end
+            limit = distance
+        else:
+            if self._position - self._offset > distance or self._offset == 0:
+                return
+            offset = max(0, self._offset - distance)
+            limit = self._offset - offset
+
+        logging.debug('prefetching, offset: %r limit: %r', offset, limit)
+        query = self._query.copy()
+        query['limit'] = limit
+        query['offset'] = offset
+        self._prefetching = True
+        self.find_async(query,
+                        functools.partial(self.__prefetch_reply_cb, offset),
+                        self.__prefetch_error_cb)
+
+    def __prefetch_reply_cb(self, offset, entries, total_count):
+        self._prefetching = False
+
+        if offset == self._offset + len(self._cache):
+            self._cache.append_all(entries)
+            self._apply_cache_limit(forward=True)
+        elif offset + len(entries) == self._offset:
+            self._cache.prepend_all(entries)
+            self._offset = offset
+            self._apply_cache_limit(forward=False)
+        else:
+            # The cache has been remade in the meantime
+            return
+        self._total_count = total_count
+
+    def __prefetch_error_cb(self, error):
+        self._prefetching = False
+        logging.error('Error while prefetching entries: %s', error)
+
+    def _is_fetching(self):
+        """Whether entries are on their way for positions known so far"""
+        return self._prefetching
+
+    def _is_fully_cached(self):
+        return self._offset == 0 and len(self._cache) == self._total_count
+
+    def _find_cached(self, uid):
+        for index in xrange(len(self._cache)):
+            if self._cache[index]['uid'] == uid:
+                return index
+        return None
+
+    def _get_sort_key(self, entry):
+        """Key that sorts entries in the order of the query, ascending"""
+        property_ = self._query.get('order_by', ['+timestamp'])[0]
+        try:
+            key = float(entry.get(property_[1:], 0))
+        except (TypeError, ValueError):
+            key = 0
+        if property_[0] == '+':
+            key = -key
+        return key
+
+    def _matches(self, entry):
+        """Whether entry matches the query
+
+        Returns None if that can't be told without querying again.
+        """
+        for key, value in self._query.iteritems():
+            if key in ('order_by', 'limit', 'offset') or not value:
+                continue
+            if key in ('keep', 'activity'):
+                if entry.get(key) != str(value):
+                    return False
+            elif key == 'mime_type':
+                if entry.get('mime_type') not in value:
+                    return False
+            else:
+                return None
+        return True
+
+    def _locate(self, entry):
+        """Return the position entry would have in the result set
+
+        Returns -1 if entry does not match the query, or None if its
+        position can't be told from the cached entries.
+        """
+        matches = self._matches(entry)
+        if matches is None:
+            return None
+        if not matches:
+            return -1
+
+        key = self._get_sort_key(entry)
+        index = 0
+        while index < len(self._cache) and \
+                self._get_sort_key(self._cache[index]) <= key:
+            index += 1
+
+        if index == 0 and self._offset > 0:
+            return None
+        if index == len(self._cache) and \
+                self._offset + len(self._cache) < self._total_count:
+            return None
+        return self._offset + index
+
+    def remove_entry(self, uid):
+        """Drop the entry uid from the result set without querying again
+
+        Returns the position it had, -1 if it was not part of the result
+        set, or None if the change can't be applied and the query needs to
+        be run again.
+        """
+        if self._total_count == -1 or self._is_fetching():
+            return None
+
+        index = self._find_cached(uid)
+        if index is None:
+            if self._is_fully_cached():
+                return -1
+            return None
+
+        del self._cache[index]
+        self._total_count -= 1
+        return self._offset + index
+
+    def insert_entry(self, entry):
+        """Add a new entry to the result set without querying again
+
+        Returns the position it got, -1 if it does not match the query, or
+        None if the change can't be applied and the query needs to be run
+        again.
+        """
+        if self._total_count == -1 or self._is_fetching():
+            return None
+
+        position = self._locate(entry)
+        if position is None or position == -1:
+            return position
+
+        self._cache.insert(position - self._offset, entry)
+        self._total_count += 1
+        return position
+
+    def update_entry(self, entry):
+        """Replace the entry with the same uid without querying again
+
+        Returns the old and new positions of the entry, either being -1 if
+        the entry was not or is no longer part of the result set, or None
+        if the change can't be applied and the query needs to be run again.
+        """
+        if self._total_count == -1 or self._is_fetching():
+            return None
+
+        index = self._find_cached(entry['uid'])
+        if index is None:
+            if not self._is_fully_cached():
+                return None
+            old_position = -1
+        else:
+            old_entry = self._cache[index]
+            del self._cache[index]
+            self._total_count -= 1
+            old_position = self._offset + index
+
+        new_position = self._locate(entry)
+        if new_position is None:
+            if index is not None:
+                self._cache.insert(index, old_entry)
+                self._total_count += 1
+            return None
+
+        if new_position != -1:
+            self._cache.insert(new_position - self._offset, entry)
+            self._total_count += 1
+        return old_position, new_position
 
 
 class DatastoreResultSet(BaseResultSet):
@@ -219,6 +524,111 @@ class DatastoreResultSet(BaseResultSet):
             query['query'] = query_text
 
         BaseResultSet.__init__(self, query, page_size)
+        self._stopped = False
+        self._missing_window = None
+        self._missing_fetches = 0
+
+    def setup(self):
+        # The view only needs the count to get going, so don't make it
+        # wait for the entries of the first pages.
+        query = self._query.copy()
+        query['limit'] = 1
+        _get_datastore().find(query, _COUNT_PROPERTIES, byte_arrays=True,
+                              reply_handler=self.__setup_reply_cb,
+                              error_handler=self.__setup_error_cb)
+        self._fetch_around(0)
+
+    def __setup_reply_cb(self, entries_, total_count):
+        if self._stopped:
+            return
+        self._total_count = total_count
+        self.ready.send(self)
+
+    def __setup_error_cb(self, error):
+        logging.error('Error while querying the data store: %s', error)
+        if self._stopped:
+            return
+        self._total_count = 0
+        self.ready.send(self)
+
+    def stop(self):
+        self._stopped = True
+
+    def read(self):
+        """Return the entry at the current position, or None
+
+        Entries that are not cached are requested from the data store
+        without blocking; the fetched signal is sent once they arrive.
+        """
+        if self._position == -1:
+            self.seek(0)
+
+        index = self._position - self._offset
+        if 0 <= index < len(self._cache):
+            entry = self._cache[index]
+            self._prefetch()
+            return entry
+
+        self._fetch_around(self._position)
+        return None
+
+    def _fetch_around(self, position):
+        if self._missing_window is not None:
+            offset, limit = self._missing_window
+            if offset <= position < offset + limit:
+                # Already on its way
+                return
+
+        limit = self._page_size * MIN_PAGES_TO_CACHE
+        offset = max(0, position - limit / 2)
+        logging.debug('fetching missing entries, offset: %r limit: %r',
+                      offset, limit)
+        query = self._query.copy()
+        query['limit'] = limit
+        query['offset'] = offset
+        self._missing_window = (offset, limit)
+        self._missing_fetches += 1
+        self.find_async(query,
+                        functools.partial(self.__missing_reply_cb,
+                                          self._missing_fetches, offset),
+                        self.__missing_error_cb)
+
+    def __missing_reply_cb(self, fetch, offset, entries, total_count):
+        if self._stopped or fetch != self._missing_fetches:
+            # A later request replaces this one
+            return
+        self._missing_window = None
+
+        del self._cache[:]
+        self._cache.append_all(entries)
+        self._offset = offset
+        self._total_count = total_count
+        self.fetched.send(self, offset=offset, count=len(entries))
+
+    def __missing_error_cb(self, error):
+        self._missing_window = None
+        logging.error('Error while fetching entries: %s', error)
+
+    def _is_fetching(self):
+        return self._missing_window is not None or \
+                BaseResultSet._is_fetching(self)
+
+    def count(self):
+        query = self._query.copy()
+        query['limit'] = 1
+        entries_, total_count = _get_datastore().find(query,
+                                                      _COUNT_PROPERTIES,
+                                                      byte_arrays=True)
+        return total_count
+
+    def get_object_ids(self):
+        query = self._query.copy()
+        query.pop('limit', None)
+        query.pop('offset', None)
+        entries, total_count_ = _get_datastore().find(query,
+                                                      _COUNT_PROPERTIES,
+                                                      byte_arrays=True)
+        return [entry['uid'] for entry in entries]
 
     def find(self, query):
         entries, total_count = _get_datastore().find(query, PROPERTIES,
@@ -229,6 +639,17 @@ class DatastoreResultSet(BaseResultSet):
 
         return entries, total_count
 
+    def find_async(self, query, reply_handler, error_handler):
+
+        def find_reply_cb(entries, total_count):
+            for entry in entries:
+                entry['mountpoint'] = '/'
+            reply_handler(entries, total_count)
+
+        _get_datastore().find(query, PROPERTIES, byte_arrays=True,
+                              reply_handler=find_reply_cb,
+                              error_handler=error_handler)
+
 
 class InplaceResultSet(BaseResultSet):
     """Encapsulates the result of a query on a mount point
@@ -236,22 +657,27 @@ class InplaceResultSet(BaseResultSet):
     def __init__(self, query, page_size, mount_point):
         BaseResultSet.__init__(self, query, page_size)
         self._mount_point = mount_point
+        self._index = None
         self._file_list = None
-        self._pending_directories = []
-        self._visited_directories = []
-        self._pending_files = []
+        self._sort_keys = None
+        self._new_files = []
+        self._last_batch_time = 0
+        self._pending_directories = deque()
+        self._indexed_files = deque()
+        self._visited_directories = set()
+        self._scanned_directories = []
+        self._workers = None
+        self._next_sequence = 0
+        self._next_result = 0
+        self._results = {}
         self._stopped = False
 
-        query_text = query.get('query', '')
-        if query_text.startswith('"') and query_text.endswith('"'):
-            self._regex = re.compile('*%s*' % query_text.strip(['"']))
-        elif query_text:
-            expression = ''
-            for word in query_text.split(' '):
-                expression += '(?=.*%s.*)' % word
-            self._regex = re.compile(expression, re.IGNORECASE)
-        else:
-            self._regex = None
+        self._search_query = None
+        self._search_hits = None
+        if query.get('query', ''):
+            search_query = volumeindex.parse_query(query['query'])
+            if search_query.words:
+                self._search_query = search_query
 
         if query.get('timestamp', ''):
             self._date_start = int(query['timestamp']['start'])
@@ -263,28 +689,50 @@ class InplaceResultSet(BaseResultSet):
         self._mime_types = query.get('mime_type', [])
 
         self._sort = query.get('order_by', ['+timestamp'])[0]
+        if self._sort[1:] == 'filesize':
+            self._sort_index = 3
+        else:
+            # timestamp
+            self._sort_index = 2
 
     def setup(self):
         self._file_list = []
-        self._pending_directories = [self._mount_point]
-        self._visited_directories = []
-        self._pending_files = []
+        self._sort_keys = []
+        self._new_files = []
+        self._last_batch_time = 0
+        self._index = volumeindex.get_index(self._mount_point,
+                                            JOURNAL_METADATA_DIR)
+        self._search_hits = None
+        self._pending_directories = deque([self._mount_point])
+        self._indexed_files = deque()
+        self._visited_directories = set()
+        self._scanned_directories = []
+        self._workers = _Workers(_read_file_info, _get_scan_workers())
+        self._next_sequence = 0
+        self._next_result = 0
+        self._results = {}
         GObject.idle_add(self._scan)
 
     def stop(self):
         self._stopped = True
+        if self._workers is not None:
+            self._workers.stop()
 
     def setup_ready(self):
-        if self._sort[1:] == 'filesize':
-            keygetter = itemgetter(3)
-        else:
-            # timestamp
-            keygetter = itemgetter(2)
-        self._file_list.sort(lambda a, b: cmp(b, a),
-                             key=keygetter,
-                             reverse=(self._sort[0] == '-'))
         self.ready.send(self)
 
+    def get_length(self):
+        if self._file_list is None:
+            return 0
+        return len(self._file_list)
+
+    length = property(get_length)
+
+    def get_object_ids(self):
+        if self._file_list is None:
+            return []
+        return [file_info[0] for file_info in self._file_list]
+
     def find(self, query):
         if self._file_list is None:
             raise ValueError('Need to call setup() first')
@@ -301,9 +749,12 @@ class InplaceResultSet(BaseResultSet):
         files = self._file_list[offset:offset + limit]
 
         entries = []
-        for file_path, stat, mtime_, size_, metadata in files:
-            if metadata is None:
-                metadata = _get_file_metadata(file_path, stat)
+        for position, file_info in enumerate(files, offset):
+            file_path, stat = file_info[:2]
+            stat = self._check_file(position, file_path, stat)
+            # Previews are not shown in the list
+            metadata = _get_file_metadata(file_path, stat,
+                                          preview_handle=True)
             metadata['mountpoint'] = self._mount_point
             entries.append(metadata)
 
@@ -311,80 +762,178 @@ class InplaceResultSet(BaseResultSet):
 
         return entries, total_count
 
+    def _check_file(self, position, file_path, stat):
+        """Make sure a row about to be shown is still current
+
+        Files in directories that did not change are taken from the index
+        without looking at them, so files modified in place or removed
+        since are only noticed here, once they get shown. Returns the
+        stat to show the row with.
+        """
+        indexed_entry = self._index.get_file(file_path)
+        if indexed_entry is None:
+            # Read while scanning, not from the index
+            return stat
+
+        entry = _read_file_info(file_path, self._mount_point, indexed_entry)
+        if entry is indexed_entry:
+            return stat
+
+        if entry is None:
+            self._index.remove_file(file_path)
+            GObject.idle_add(self.__file_deleted_cb, file_path)
+            return stat
+
+        if not entry.is_link:
+            self._index.set_file(file_path, entry.stat, entry.mime_type,
+                                 entry.metadata, entry.terms)
+        stat = entry.stat
+        file_info = (file_path, stat, int(stat.st_mtime), stat.st_size)
+        self._file_list[position] = file_info
+        # The row stays where it is until the next scan, but the files
+        # inserted until then must not be compared against the old values
+        self._sort_keys[position] = self._get_sort_key(file_info)
+        return stat
+
+    def __file_deleted_cb(self, file_path):
+        if not self._stopped:
+            deleted.send(None, object_id=file_path)
+        return False
+
+    def remove_entry(self, uid):
+        if self._file_list is None or self._pending_directories or \
+                self._indexed_files or self._next_result < self._next_sequence or \
+                self._new_files or self._is_fetching():
+            # Still scanning, or entries are on their way
+            return None
+
+        for position, file_info in enumerate(self._file_list):
+            if file_info[0] == uid:
+                break
+        else:
+            return -1
+
+        del self._file_list[position]
+        del self._sort_keys[position]
+        if position < self._offset:
+            self._offset -= 1
+        elif position < self._offset + len(self._cache):
+            del self._cache[position - self._offset]
+        return position
+
+    def insert_entry(self, entry):
+        # New and updated files need to be found by scanning again
+        return None
+
+    def update_entry(self, entry):
+        return None
+
     def _scan(self):
         if self._stopped:
             return False
 
+        if not self._index.is_loaded():
+            GObject.timeout_add(_SCAN_POLL_INTERVAL, self._scan)
+            return False
+
+        if self._search_query is not None and self._search_hits is None:
+            # Files taken from the index are matched against what it
+            # knows, the rest as they are read
+            self._search_hits = dict(self._index.search(self._search_query))
+
         self.progress.send(self)
 
-        if self._pending_files:
-            self._scan_a_file()
-            return True
+        # Process as many entries as fit in the time slice so the cost of
+        # going through the main loop is shared by many of them.
+        deadline = time.time() + _SCAN_TIME_SLICE
+        if self._new_files and \
+                time.time() - self._last_batch_time > _SCAN_BATCH_INTERVAL:
+            if not self._add_new_files(deadline):
+                GObject.idle_add(self._scan)
+                return False
+
+        while True:
+            if not self._process_results(deadline):
+                GObject.idle_add(self._scan)
+            elif self._indexed_files:
+                self._add_indexed_files(deadline)
+                if time.time() < deadline:
+                    continue
+                GObject.idle_add(self._scan)
+            elif self._pending_directories:
+                self._scan_a_directory()
+                if time.time() < deadline:
+                    continue
+                GObject.idle_add(self._scan)
+            elif self._next_result < self._next_sequence:
+                # Wait for the workers without spinning the main loop
+                GObject.timeout_add(_SCAN_POLL_INTERVAL, self._scan)
+            else:
+                break
+            return False
 
-        if self._pending_directories:
-            self._scan_a_directory()
-            return True
+        if not self._add_new_files(deadline):
+            GObject.idle_add(self._scan)
+            return False
 
+        self._workers.stop()
+        self._index.prune(self._scanned_directories)
+        self._index.save()
         self.setup_ready()
-        self._visited_directories = []
+        self._visited_directories = set()
+        self._scanned_directories = []
         return False
 
-    def _scan_a_file(self):
-        full_path = self._pending_files.pop(0)
-        metadata = None
+    def _queue_file(self, full_path):
+        """Have the workers read the information about a file
 
-        try:
-            stat = os.lstat(full_path)
-        except OSError, e:
-            if e.errno != errno.ENOENT:
-                logging.exception(
-                    'Error reading metadata of file %r', full_path)
-            return
+        Every file gets a sequence number so the results are processed in
+        the same order the files were found, whichever worker read them.
+        """
+        sequence = self._next_sequence
+        self._next_sequence += 1
+        self._workers.submit(sequence, full_path, self._mount_point)
 
-        if S_IFMT(stat.st_mode) == S_IFLNK:
-            try:
-                link = os.readlink(full_path)
-            except OSError, e:
-                logging.exception(
-                    'Error reading target of link %r', full_path)
-                return
+    def _process_results(self, deadline):
+        """Add the files read by the workers, until deadline
 
-            if not os.path.abspath(link).startswith(self._mount_point):
-                return
+        Returns False if some results were left for the next time slice.
+        """
+        for sequence, args, result in self._workers.get_results():
+            full_path = args[0]
+            self._results[sequence] = (full_path, result)
 
-            try:
-                stat = os.stat(full_path)
+        while self._next_result in self._results:
+            if time.time() >= deadline:
+                return False
 
-            except OSError, e:
-                if e.errno != errno.ENOENT:
-                    logging.exception(
-                        'Error reading metadata of linked file %r', full_path)
-                return
+            full_path, entry = self._results.pop(self._next_result)
+            self._next_result += 1
+
+            if entry is None:
+                self._index.remove_file(full_path)
+                continue
+            if not entry.is_link:
+                self._index.set_file(full_path, entry.stat, entry.mime_type,
+                                     entry.metadata, entry.terms)
+            self._add_file(full_path, entry, False)
+        return True
+
+    def _add_file(self, full_path, entry, indexed):
+        stat = entry.stat
 
         if S_IFMT(stat.st_mode) == S_IFDIR:
             id_tuple = stat.st_ino, stat.st_dev
             if not id_tuple in self._visited_directories:
-                self._visited_directories.append(id_tuple)
+                self._visited_directories.add(id_tuple)
                 self._pending_directories.append(full_path)
             return
 
-        if S_IFMT(stat.st_mode) != S_IFREG:
-            return
-
-        if self._regex is not None and \
-                not self._regex.match(full_path):
-            metadata = _get_file_metadata(full_path, stat,
-                                          fetch_preview=False)
-            if not metadata:
-                return
-            add_to_list = False
-            for f in ['fulltext', 'title',
-                      'description', 'tags']:
-                if f in metadata and \
-                        self._regex.match(metadata[f]):
-                    add_to_list = True
-                    break
-            if not add_to_list:
+        if self._search_query is not None:
+            if indexed:
+                if full_path not in self._search_hits:
+                    return
+            elif not volumeindex.get_score(entry.terms, self._search_query):
                 return
 
         if self._date_start is not None and stat.st_mtime < self._date_start:
@@ -393,20 +942,78 @@ class InplaceResultSet(BaseResultSet):
         if self._date_end is not None and stat.st_mtime > self._date_end:
             return
 
-        if self._mime_types:
-            mime_type, uncertain_result_ = \
-                    Gio.content_type_guess(filename=full_path, data=None)
-            if mime_type not in self._mime_types:
-                return
+        if self._mime_types and entry.mime_type not in self._mime_types:
+            return
 
-        file_info = (full_path, stat, int(stat.st_mtime), stat.st_size,
-                     metadata)
-        self._file_list.append(file_info)
+        file_info = (full_path, stat, int(stat.st_mtime), stat.st_size)
+        self._new_files.append(file_info)
 
-        return
+    def _get_sort_key(self, file_info):
+        # Ascending order of the keys is descending order of the values
+        key = file_info[self._sort_index]
+        if self._sort[0] == '+':
+            key = -key
+        return key
+
+    def _add_new_files(self, deadline):
+        """Insert the files found since the last batch in the sorted list
+
+        The file list is kept sorted while scanning so the rows found so
+        far can be shown right away. Returns False if some files were left
+        for the next time slice.
+        """
+        new_files, self._new_files = self._new_files, []
+
+        for i, file_info in enumerate(new_files):
+            if i and time.time() >= deadline:
+                self._new_files = new_files[i:] + self._new_files
+                return False
+
+            key = self._get_sort_key(file_info)
+            position = bisect.bisect_right(self._sort_keys, key)
+            self._sort_keys.insert(position, key)
+            self._file_list.insert(position, file_info)
+
+            if position < self._offset:
+                self._offset += 1
+            elif position < self._offset + len(self._cache):
+                del self._cache[:]
+                self._offset = 0
+
+            self.inserted.send(self, position=position)
+
+        self._last_batch_time = time.time()
+        return True
+
+    def _add_indexed_files(self, deadline):
+        """Add the files of unchanged directories, until deadline"""
+        while self._indexed_files and time.time() < deadline:
+            full_path = self._indexed_files.popleft()
+            entry = self._index.get_file(full_path)
+            if entry is None:
+                # Links are not indexed, their target could be anything
+                self._queue_file(full_path)
+            else:
+                self._add_file(full_path, entry, True)
 
     def _scan_a_directory(self):
-        dir_path = self._pending_directories.pop(0)
+        dir_path = self._pending_directories.popleft()
+
+        try:
+            dir_mtime = int(os.stat(dir_path).st_mtime)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                logging.exception('Error reading directory %r', dir_path)
+            return
+        metadata_mtime = _get_metadata_mtime(dir_path)
+        self._scanned_directories.append(dir_path)
+
+        names = self._index.get_directory(dir_path, dir_mtime, metadata_mtime)
+        if names is not None:
+            # Answered from the index, the files get checked once shown
+            self._indexed_files.extend([os.path.join(dir_path, name) \
+                                            for name in names])
+            return
 
         try:
             entries = os.listdir(dir_path)
@@ -415,23 +1022,581 @@ class InplaceResultSet(BaseResultSet):
                 logging.exception('Error reading directory %r', dir_path)
             return
 
+        names = [entry for entry in entries if not entry.startswith('.')]
+        self._index.set_directory(dir_path, dir_mtime, metadata_mtime, names)
+        for name in names:
+            self._queue_file(os.path.join(dir_path, name))
+
+
+class _Workers(object):
+    """Threads that call function for the jobs submitted to them
+
+    The results are collected by get_results(), which is meant to be
+    called from the main loop.
+    """
+
+    def __init__(self, function, n_workers):
+        self._function = function
+        self._jobs = Queue.Queue()
+        self._results = Queue.Queue()
+        self._n_workers = n_workers
+        self._stopped = False
+
+        for i_ in range(n_workers):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, sequence, *args):
+        self._jobs.put((sequence, args))
+
+    def get_results(self):
+        results = []
+        try:
+            while True:
+                results.append(self._results.get_nowait())
+        except Queue.Empty:
+            pass
+        return results
+
+    def stop(self):
+        """Stop the threads, the jobs not started yet are dropped"""
+        self._stopped = True
+        try:
+            while True:
+                self._jobs.get_nowait()
+        except Queue.Empty:
+            pass
+
+        for i_ in range(self._n_workers):
+            self._jobs.put(None)
+        self._n_workers = 0
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            if job is None or self._stopped:
+                return
+            sequence, args = job
+            try:
+                result = self._function(*args)
+            except Exception:
+                logging.exception('Error while working on %r', args)
+                result = None
+            self._results.put((sequence, args, result))
+
+
+class BatchCopy(object):
+    """Copies or moves many entries to a mount point
+
+    The metadata of the entries is fetched and their files copied by a few
+    threads while the main loop keeps running. Entries are copied in
+    batches: once the data of a batch is on the device, the metadata of
+    its entries gets written and flushed all at once. The progress signal
+    is sent after every batch and the finished signal once all the
+    entries are done.
+    """
+
+    def __init__(self, object_ids, mount_point, move=False):
+        self._object_ids = list(object_ids)
+        self._mount_point = mount_point
+        self._move = move
+
+        self._pending = deque(self._object_ids)
+        # The copied entries of the current batch, by sequence number
+        self._jobs = {}
+        self._next_sequence = 0
+        self._in_flight = 0
+        self._names = None
+        self._names_lock = threading.Lock()
+        self._user_color = None
+        # Set by the thread writing the metadata of a batch once done
+        self._written = None
+        self._n_writing = 0
+        self._workers = None
+        self._cancelled = False
+        self._bytes_lock = threading.Lock()
+        self._last_progress_time = 0
+        self.copied = 0
+        self.failed = 0
+        self.bytes_copied = 0
+
+        self.progress = dispatch.Signal()
+        self.finished = dispatch.Signal()
+
+    def get_total(self):
+        return len(self._object_ids)
+
+    total = property(get_total)
+
+    def get_mount_point(self):
+        return self._mount_point
+
+    mount_point = property(get_mount_point)
+
+    def add(self, object_ids):
+        """Copy more entries, after the ones already asked for"""
+        self._object_ids.extend(object_ids)
+        self._pending.extend(object_ids)
+
+    def start(self):
+        if self._mount_point != '/':
+            metadata_dir_path = os.path.join(self._mount_point,
+                                             JOURNAL_METADATA_DIR)
+            try:
+                if not os.path.exists(metadata_dir_path):
+                    os.mkdir(metadata_dir_path)
+                # Unique names are found without asking the device again
+                # for every entry. FAT doesn't care about case.
+                self._names = set([name.lower() for name in
+                                   os.listdir(self._mount_point)])
+            except EnvironmentError:
+                logging.exception('Could not copy entries to %r',
+                                  self._mount_point)
+                self.failed = len(self._pending)
+                self._pending.clear()
+                GObject.idle_add(self._finish)
+                return
+        else:
+            client = GConf.Client.get_default()
+            self._user_color = client.get_string('/desktop/sugar/user/color')
+
+        # Make sure the proxy is not created by the threads
+        _get_datastore()
+        self._workers = _Workers(self._copy_entry, _COPY_WORKERS)
+        GObject.idle_add(self._start_batch)
+
+    def cancel(self):
+        """Stop copying, files only partially copied are removed"""
+        self._cancelled = True
+
+    def _add_bytes_copied(self, count):
+        """Called by the threads as data gets copied
+
+        Returns False if the copy has been cancelled.
+        """
+        with self._bytes_lock:
+            self.bytes_copied += count
+        return not self._cancelled
+
+    def _start_batch(self):
+        if self._cancelled or not self._pending:
+            self._finish()
+            return False
+
+        for i_ in range(min(_COPY_BATCH_SIZE, len(self._pending))):
+            self._workers.submit(self._next_sequence,
+                                 self._pending.popleft())
+            self._next_sequence += 1
+            self._in_flight += 1
+
+        GObject.timeout_add(_COPY_POLL_INTERVAL, self._check_batch)
+        return False
+
+    def _copy_entry(self, object_id):
+        """Copy an entry, called by the threads
+
+        Returns the metadata of the entry, the object id of the copy and,
+        for devices, the checksum of the data; False if the entry already
+        is on the mount point and None if it could not be copied.
+        """
+        if self._cancelled:
+            return None
+
+        metadata = get(object_id)
+        if metadata.get('mountpoint') == self._mount_point:
+            return False
+
+        file_path = get_readonly_file(object_id)
+
+        if self._mount_point == '/':
+            if metadata.get('icon-color') == '#000000,#ffffff':
+                metadata['icon-color'] = self._user_color
+            metadata_copy = metadata.copy()
+            metadata_copy['mountpoint'] = '/'
+            del metadata_copy['uid']
+            new_object_id = _copy_to_datastore(metadata_copy, file_path or '')
+            return metadata, new_object_id, None
+
+        if not file_path or not os.path.exists(file_path):
+            logging.warning('Entry %r has no file to copy', object_id)
+            return None
+
+        if not metadata.get('title'):
+            metadata['title'] = _('Untitled')
+        file_name = get_file_name(metadata['title'], metadata['mime_type'])
+        with self._names_lock:
+            file_name = _get_unique_name(self._names, file_name)
+            self._names.add(file_name.lower())
+
+        destination_path = os.path.join(self._mount_point, file_name)
+        checksum = _copy_file(file_path, destination_path,
+                              self._add_bytes_copied)
+        if checksum is None:
+            return None
+        return metadata, destination_path, checksum
+
+    def _check_batch(self):
+        for sequence, args, result in self._workers.get_results():
+            self._in_flight -= 1
+            if result is None:
+                if not self._cancelled:
+                    self.failed += 1
+            elif result is False:
+                # Already there, nothing to do
+                self.copied += 1
+            else:
+                self._jobs[sequence] = (args[0], ) + result
+
+        if self._in_flight:
+            if time.time() - self._last_progress_time > \
+                    _COPY_PROGRESS_INTERVAL:
+                self._send_progress()
+            return True
+
+        self._finish_batch()
+        return False
+
+    def _finish_batch(self):
+        jobs, self._jobs = self._jobs, {}
+        entries = [jobs[sequence] for sequence in sorted(jobs.keys())]
+
+        if self._mount_point == '/':
+            self._add_copied(entries)
+            return
+
+        # The metadata of the entries only gets written once their data is
+        # on the device, all of the batch at once by a thread that then
+        # flushes it to the device
+        self._written = None
+        self._n_writing = len(entries)
+        thread = threading.Thread(target=self._write_metadata,
+                                  args=(entries, ))
+        thread.daemon = True
+        thread.start()
+        GObject.timeout_add(_COPY_POLL_INTERVAL, self.__metadata_written_cb)
+
+    def _write_metadata(self, entries):
+        written = []
         for entry in entries:
-            if entry.startswith('.'):
+            object_id_, metadata, new_object_id, checksum = entry
+            file_name = os.path.basename(new_object_id)
+            metadata['title'] = os.path.splitext(file_name)[0]
+            metadata['checksum'] = checksum
+            try:
+                _write_metadata_files(_get_metadata_copy(metadata),
+                                      self._mount_point, file_name)
+            except EnvironmentError:
+                logging.exception('Could not write the metadata of %r',
+                                  new_object_id)
                 continue
-            self._pending_files.append(dir_path + '/' + entry)
+            written.append(entry)
+        _sync(self._mount_point)
+        self._written = written
+
+    def __metadata_written_cb(self):
+        if self._written is None:
+            return True
+
+        self.failed += self._n_writing - len(self._written)
+        self._add_copied(self._written)
+        return False
+
+    def _add_copied(self, entries):
+        """Account for the copied entries of a batch, on the main loop"""
+        for object_id, metadata_, new_object_id, checksum_ in entries:
+            if self._mount_point != '/':
+                created.send(None, object_id=new_object_id)
+
+            self.copied += 1
+            if self._move:
+                try:
+                    delete(object_id)
+                except Exception:
+                    logging.exception('Could not remove %r after moving it',
+                                      object_id)
+
+        self._send_progress()
+        GObject.idle_add(self._start_batch)
+
+    def _send_progress(self):
+        self._last_progress_time = time.time()
+        self.progress.send(self, copied=self.copied, failed=self.failed,
+                           total=self.total, bytes_copied=self.bytes_copied)
+
+    def _finish(self):
+        if self._workers is not None:
+            self._workers.stop()
+            self._workers = None
+        self.finished.send(self, copied=self.copied, failed=self.failed,
+                           total=self.total)
+        return False
+
+
+def _copy_to_datastore(metadata, file_path):
+    return write(metadata, file_path, transfer_ownership=False)
+
+
+def _copy_file(file_path, destination_path, progress_cb=None):
+    """Copy a file to a removable device, returning its MD5 checksum
+
+    The data is written to a partial file in the metadata directory of
+    the device, which is synced before being moved into place. A partial
+    file left behind by a copy that was interrupted (e.g. by the device
+    being removed) is resumed if it has the same data as the source so
+    far. Copies that fail or get stopped remove their partial file.
+
+    progress_cb gets called with the number of bytes copied as the copy
+    goes on; if it returns False the copy is stopped and None returned.
+    """
+    dir_path, file_name = os.path.split(destination_path)
+    partial_path = os.path.join(dir_path, JOURNAL_METADATA_DIR,
+                                file_name + _PARTIAL_SUFFIX)
+    checksum = hashlib.md5()
+
+    try:
+        if not _copy_data(file_path, partial_path, checksum, progress_cb):
+            _remove_partial_file(partial_path)
+            return None
+    except EnvironmentError:
+        _remove_partial_file(partial_path)
+        raise
+
+    os.rename(partial_path, destination_path)
+    try:
+        shutil.copymode(file_path, destination_path)
+    except OSError:
+        # Not all file systems on removable devices have permissions
+        pass
+
+    return checksum.hexdigest()
+
+
+def _copy_data(file_path, partial_path, checksum, progress_cb):
+    """Copy file_path to partial_path, returning False if stopped"""
+    source = open(file_path, 'rb')
+    try:
+        offset = _get_resume_offset(source, partial_path, checksum)
+        if offset:
+            logging.debug('Resuming copy of %r at %d', partial_path, offset)
+            destination = open(partial_path, 'r+b')
+        else:
+            destination = open(partial_path, 'wb')
+        try:
+            destination.seek(offset)
+            destination.truncate()
+            if progress_cb is not None and offset:
+                progress_cb(offset)
+
+            while True:
+                data = source.read(_COPY_BUFFER_SIZE)
+                if not data:
+                    break
+                destination.write(data)
+                checksum.update(data)
+                if progress_cb is not None and not progress_cb(len(data)):
+                    return False
+
+            destination.flush()
+            os.fsync(destination.fileno())
+        finally:
+            destination.close()
+    finally:
+        source.close()
+    return True
+
+
+def _remove_partial_file(partial_path):
+    try:
+        os.unlink(partial_path)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            logging.error('Could not remove %r: %s', partial_path, e)
+
+
+def _get_resume_offset(source, partial_path, checksum):
+    """Return up to where partial_path has the same data as source
+
+    source is left at that offset, and checksum updated with the data
+    before it.
+    """
+    try:
+        partial = open(partial_path, 'rb')
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            logging.warning('Could not read %r: %s', partial_path, e)
+        return 0
+
+    offset = 0
+    try:
+        while True:
+            data = partial.read(_COPY_BUFFER_SIZE)
+            if not data or source.read(len(data)) != data:
+                break
+            checksum.update(data)
+            offset += len(data)
+    finally:
+        partial.close()
+
+    source.seek(offset)
+    return offset
+
+
+def _sync(path):
+    """Flush to disk the data written to the file system of path"""
+    libc = ctypes.CDLL(None, use_errno=True)
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        libc.sync()
         return
+    try:
+        if not hasattr(libc, 'syncfs') or libc.syncfs(fd) != 0:
+            libc.sync()
+    finally:
+        os.close(fd)
+
+
+def _get_unique_name(names, file_name):
+    """Like get_unique_file_name(), for the lower-case names in names"""
+    if file_name.lower() in names:
+        i = 1
+        name, extension = os.path.splitext(file_name)
+        while len(file_name) <= 255:
+            file_name = name + '_' + str(i) + extension
+            if file_name.lower() not in names:
+                break
+            i += 1
+
+    return file_name
+
+
+def _get_scan_workers():
+    client = GConf.Client.get_default()
+    n_workers = client.get_int('/desktop/sugar/journal/scan_workers')
+    if n_workers < 1:
+        n_workers = _DEFAULT_SCAN_WORKERS
+    return n_workers
+
+
+def _read_file_info(full_path, mount_point, indexed_entry=None):
+    """Read the information the volume index keeps about a file
+
+    Returns indexed_entry if the file did not change since it was indexed
+    and None for anything that is neither a regular file nor a directory.
+    This mostly runs in the scan worker threads, so it must not touch the
+    index itself.
+    """
+    try:
+        stat = os.lstat(full_path)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            logging.exception(
+                'Error reading metadata of file %r', full_path)
+        return None
+
+    if indexed_entry is not None:
+        indexed_stat = indexed_entry.stat
+        if stat.st_mode == indexed_stat.st_mode and \
+                stat.st_ino == indexed_stat.st_ino and \
+                stat.st_size == indexed_stat.st_size and \
+                int(stat.st_mtime) == indexed_stat.st_mtime:
+            return indexed_entry
+
+    is_link = S_IFMT(stat.st_mode) == S_IFLNK
+    if is_link:
+        try:
+            link = os.readlink(full_path)
+        except OSError, e:
+            logging.exception(
+                'Error reading target of link %r', full_path)
+            return None
+
+        if not os.path.abspath(link).startswith(mount_point):
+            return None
+
+        try:
+            stat = os.stat(full_path)
+
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                logging.exception(
+                    'Error reading metadata of linked file %r', full_path)
+            return None
+
+    relative_path = os.path.relpath(full_path, mount_point)
+    if S_IFMT(stat.st_mode) == S_IFDIR:
+        return _FileInfo(stat, None, None, is_link,
+                         volumeindex.get_terms(relative_path, None))
+
+    if S_IFMT(stat.st_mode) != S_IFREG:
+        return None
 
+    mime_type, uncertain_result_ = \
+            Gio.content_type_guess(filename=full_path, data=None)
+    metadata = _get_file_metadata_from_json(os.path.dirname(full_path),
+                                            os.path.basename(full_path),
+                                            fetch_preview=False)
+    return _FileInfo(stat, mime_type, metadata, is_link,
+                     volumeindex.get_terms(relative_path, metadata))
 
-def _get_file_metadata(path, stat, fetch_preview=True):
+
+def _get_max_pages_to_cache():
+    """Return how many pages result sets may cache, given the free memory"""
+    global _max_pages_to_cache, _last_memory_check
+
+    now = time.time()
+    if now - _last_memory_check < _MEMORY_CHECK_INTERVAL:
+        return _max_pages_to_cache
+    _last_memory_check = now
+
+    available = 0
+    try:
+        meminfo = open('/proc/meminfo')
+        try:
+            for line in meminfo:
+                name, value = line.split(':', 1)
+                if name in ['MemFree', 'Buffers', 'Cached']:
+                    available += int(value.split()[0])
+        finally:
+            meminfo.close()
+    except (EnvironmentError, ValueError):
+        logging.exception('Could not read the amount of free memory')
+        _max_pages_to_cache = MAX_PAGES_TO_CACHE
+        return _max_pages_to_cache
+
+    # One more multiple of MAX_PAGES_TO_CACHE for every 64 MB available
+    if available < 32 * 1024:
+        _max_pages_to_cache = MIN_PAGES_TO_CACHE
+    else:
+        _max_pages_to_cache = MAX_PAGES_TO_CACHE * \
+                max(1, min(4, available / (64 * 1024)))
+    return _max_pages_to_cache
+
+
+def _get_metadata_mtime(dir_path):
+    """Return the mtime of the metadata directory inside dir_path, or 0"""
+    try:
+        return int(os.stat(os.path.join(dir_path,
+                                        JOURNAL_METADATA_DIR)).st_mtime)
+    except OSError:
+        return 0
+
+
+def _get_file_metadata(path, stat, fetch_preview=True, preview_handle=False):
     """Return the metadata from the corresponding file.
 
     Reads the metadata stored in the json file or create the
     metadata based on the file properties.
 
+    With preview_handle, the preview is not read but get_preview() will
+    read it when asked for.
+
     """
     filename = os.path.basename(path)
     dir_path = os.path.dirname(path)
-    metadata = _get_file_metadata_from_json(dir_path, filename, fetch_preview)
+    metadata = _get_file_metadata_from_json(dir_path, filename, fetch_preview,
+                                            preview_handle)
     if metadata:
         if 'filesize' not in metadata:
             metadata['filesize'] = stat.st_size
@@ -450,7 +1615,8 @@ def _get_file_metadata(path, stat, fetch_preview=True):
             'description': path}
 
 
-def _get_file_metadata_from_json(dir_path, filename, fetch_preview):
+def _get_file_metadata_from_json(dir_path, filename, fetch_preview,
+                                 preview_handle=False):
     """Read the metadata from the json file and the preview
     stored on the external device.
 
@@ -478,9 +1644,17 @@ def _get_file_metadata_from_json(dir_path, filename, fetch_preview):
     else:
         metadata['uid'] = os.path.join(dir_path, filename)
 
-    if not fetch_preview:
+    if not fetch_preview or preview_handle:
         if 'preview' in metadata:
             del(metadata['preview'])
+        if fetch_preview:
+            try:
+                size = os.stat(preview_path).st_size
+            except OSError:
+                pass
+            else:
+                metadata[_PREVIEW_HANDLE] = _PreviewHandle(preview_path,
+                                                           size)
     else:
         if os.path.exists(preview_path):
             try:
@@ -492,6 +1666,32 @@ def _get_file_metadata_from_json(dir_path, filename, fetch_preview):
     return metadata
 
 
+def get_preview(metadata):
+    """Return the PNG data of the preview of an entry, or None"""
+    if metadata.get('preview'):
+        return metadata['preview']
+
+    handle = metadata.get(_PREVIEW_HANDLE)
+    if handle is None or not handle.size:
+        return None
+    try:
+        with open(handle.path) as preview_file:
+            return dbus.ByteArray(preview_file.read())
+    except EnvironmentError:
+        logging.debug('Could not read preview %r', handle.path)
+        return None
+
+
+def _resolve_preview(metadata):
+    """Replace the preview handle in metadata with the preview itself"""
+    if _PREVIEW_HANDLE not in metadata:
+        return
+    preview = get_preview(metadata)
+    del metadata[_PREVIEW_HANDLE]
+    if preview is not None:
+        metadata['preview'] = preview
+
+
 def _get_datastore():
     global _datastore
     if _datastore is None:
@@ -556,6 +1756,25 @@ def get(object_id):
     return metadata
 
 
+def get_properties_async(object_id, properties, reply_handler,
+                         error_handler):
+    """Fetch some properties of an entry in the data store
+
+    Unlike get(), this doesn't block and only the properties asked for
+    are transferred. reply_handler gets called with a dict of them, which
+    is empty if the entry is gone.
+    """
+    def find_reply_cb(entries, total_count_):
+        if entries:
+            reply_handler(entries[0])
+        else:
+            reply_handler({})
+
+    _get_datastore().find({'uid': object_id}, properties, byte_arrays=True,
+                          reply_handler=find_reply_cb,
+                          error_handler=error_handler)
+
+
 def get_file(object_id):
     """Returns the file for an object
     """
@@ -571,13 +1790,52 @@ def get_file(object_id):
             return None
 
 
-def get_file_size(object_id):
+def get_readonly_file(object_id):
+    """Returns the file for an object, for reading only
+
+    Unlike get_file(), files in the data store are not copied when
+    possible, so the file must be neither modified nor deleted.
+    """
+    if os.path.exists(object_id):
+        return object_id
+
+    file_path = _get_datastore_file_path(object_id)
+    if file_path is not None:
+        return file_path
+
+    return get_file(object_id)
+
+
+def _get_datastore_file_path(object_id):
+    """Return the path where the data store keeps the file of an entry"""
+    if not object_id or os.sep in object_id:
+        return None
+    file_path = os.path.join(env.get_profile_path('datastore'),
+                             object_id[:2], object_id, 'data')
+    if not os.path.isfile(file_path):
+        return None
+    return file_path
+
+
+def get_file_size(object_id, metadata=None):
     """Return the file size for an object
+
+    The size recorded in the metadata of the entry is used if given.
     """
     logging.debug('get_file_size %r', object_id)
     if os.path.exists(object_id):
         return os.stat(object_id).st_size
 
+    if metadata is not None:
+        try:
+            return int(metadata['filesize'])
+        except (KeyError, TypeError, ValueError):
+            pass
+
+    file_path = _get_datastore_file_path(object_id)
+    if file_path is not None:
+        return os.stat(file_path).st_size
+
     file_path = _get_datastore().get_filename(object_id)
     if file_path:
         size = os.stat(file_path).st_size
@@ -624,7 +1882,7 @@ def copy(metadata, mount_point):
     if mount_point == '/' and metadata['icon-color'] == '#000000,#ffffff':
         client = GConf.Client.get_default()
         metadata['icon-color'] = client.get_string('/desktop/sugar/user/color')
-    file_path = get_file(metadata['uid'])
+    file_path = get_readonly_file(metadata['uid'])
     if file_path is None:
         file_path = ''
 
@@ -643,6 +1901,8 @@ def write(metadata, file_path='', update_mtime=True, transfer_ownership=True):
         metadata['mtime'] = datetime.now().isoformat()
         metadata['timestamp'] = int(time.time())
 
+    _resolve_preview(metadata)
+
     if metadata.get('mountpoint', '/') == '/':
         if metadata.get('uid', ''):
             object_id = _get_datastore().update(metadata['uid'],
@@ -710,50 +1970,62 @@ def _write_entry_on_external_device(metadata, file_path):
         clean_name, extension_ = os.path.splitext(file_name)
         metadata['title'] = clean_name
 
-    metadata_copy = metadata.copy()
-    metadata_copy.pop('mountpoint', None)
-    metadata_copy.pop('uid', None)
-    metadata_copy.pop('filesize', None)
-
     metadata_dir_path = os.path.join(metadata['mountpoint'],
                                      JOURNAL_METADATA_DIR)
     if not os.path.exists(metadata_dir_path):
         os.mkdir(metadata_dir_path)
 
-    preview = None
-    if 'preview' in metadata_copy:
-        preview = metadata_copy['preview']
-        preview_fname = file_name + '.preview'
-        metadata_copy.pop('preview', None)
-
-    try:
-        metadata_json = simplejson.dumps(metadata_copy)
-    except (UnicodeDecodeError, EnvironmentError):
-        logging.error('Could not convert metadata to json.')
-    else:
-        (fh, fn) = tempfile.mkstemp(dir=metadata['mountpoint'])
-        os.write(fh, metadata_json)
-        os.close(fh)
-        os.rename(fn, os.path.join(metadata_dir_path, file_name + '.metadata'))
-
-        if preview:
-            (fh, fn) = tempfile.mkstemp(dir=metadata['mountpoint'])
-            os.write(fh, preview)
-            os.close(fh)
-            os.rename(fn, os.path.join(metadata_dir_path, preview_fname))
-
+    # The metadata is only written once the data is safely on the device,
+    # so an interrupted copy doesn't leave a broken entry behind
     if not os.path.dirname(destination_path) == os.path.dirname(file_path):
-        shutil.copy(file_path, destination_path)
+        metadata['checksum'] = _copy_file(file_path, destination_path)
     else:
         _rename_entry_on_external_device(file_path, destination_path,
                                          metadata_dir_path)
 
+    _write_metadata_files(_get_metadata_copy(metadata),
+                          metadata['mountpoint'], file_name)
+
     object_id = destination_path
     created.send(None, object_id=object_id)
 
     return object_id
 
 
+def _get_metadata_copy(metadata):
+    """Return the metadata to store in .metadata files"""
+    metadata_copy = metadata.copy()
+    _resolve_preview(metadata_copy)
+    metadata_copy.pop('mountpoint', None)
+    metadata_copy.pop('uid', None)
+    metadata_copy.pop('filesize', None)
+    return metadata_copy
+
+
+def _write_metadata_files(metadata, mount_point, file_name):
+    """Write the metadata and preview of the entry file_name on a device"""
+    metadata_dir_path = os.path.join(mount_point, JOURNAL_METADATA_DIR)
+    preview = metadata.pop('preview', None)
+
+    try:
+        metadata_json = simplejson.dumps(metadata)
+    except (UnicodeDecodeError, EnvironmentError):
+        logging.error('Could not convert metadata to json.')
+        return
+
+    (fh, fn) = tempfile.mkstemp(dir=mount_point)
+    os.write(fh, metadata_json)
+    os.close(fh)
+    os.rename(fn, os.path.join(metadata_dir_path, file_name + '.metadata'))
+
+    if preview:
+        (fh, fn) = tempfile.mkstemp(dir=mount_point)
+        os.write(fh, preview)
+        os.close(fh)
+        os.rename(fn, os.path.join(metadata_dir_path,
+                                   file_name + '.preview'))
+
+
 def get_file_name(title, mime_type):
     file_name = title
 
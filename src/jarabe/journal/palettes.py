@@ -134,7 +134,6 @@ class ObjectPalette(Palette):
         misc.resume(self._metadata)
 
     def __duplicate_activate_cb(self, menu_item):
-        file_path = model.get_file(self._metadata['uid'])
         try:
             model.copy(self._metadata, '/')
         except IOError, e:
@@ -257,22 +256,8 @@ class VolumeMenu(MenuItem):
         self.connect('activate', self.__copy_to_volume_cb, mount_point)
 
     def __copy_to_volume_cb(self, menu_item, mount_point):
-        file_path = model.get_file(self._metadata['uid'])
-
-        if not file_path or not os.path.exists(file_path):
-            logging.warn('Entries without a file cannot be copied.')
-            self.emit('volume-error',
-                      _('Entries without a file cannot be copied.'),
-                      _('Warning'))
-            return
-
-        try:
-            model.copy(self._metadata, mount_point)
-        except IOError, e:
-            logging.exception('Error while copying the entry. %s', e.strerror)
-            self.emit('volume-error',
-                      _('Error while copying the entry. %s') % e.strerror,
-                      _('Error'))
+        journalwindow.get_journal_window().copy_entries(
+            [self._metadata['uid']], mount_point)
 
 
 class ClipboardMenu(MenuItem):
@@ -291,7 +276,7 @@ class ClipboardMenu(MenuItem):
         self.connect('activate', self.__copy_to_clipboard_cb)
 
     def __copy_to_clipboard_cb(self, menu_item):
-        file_path = model.get_file(self._metadata['uid'])
+        file_path = model.get_readonly_file(self._metadata['uid'])
         if not file_path or not os.path.exists(file_path):
             logging.warn('Entries without a file cannot be copied.')
             self.emit('volume-error',
@@ -305,7 +290,8 @@ class ClipboardMenu(MenuItem):
                                 self.__clipboard_clear_func_cb)
 
     def __clipboard_get_func_cb(self, clipboard, selection_data, info, data):
-        # Get hold of a reference so the temp file doesn't get deleted
+        # Whoever pastes gets a copy of the file, not the one in the data
+        # store. Get hold of a reference so it doesn't get deleted.
         self._temp_file_path = model.get_file(self._metadata['uid'])
         logging.debug('__clipboard_get_func_cb %r', self._temp_file_path)
         selection_data.set_uris(['file://' + self._temp_file_path])
@@ -0,0 +1,187 @@
+# Copyright (C) 2012 One Laptop Per Child
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Cache of the previews of Journal entries, scaled for display.
+
+Previews are stored as PNG data in the metadata of the entries, at
+whatever size the activity saved them. Decoding and scaling them is done
+once: the result is kept in memory for the most recently shown entries,
+and on disk in the profile for the rest, keyed by the entry and the time
+it was last modified so previews of entries that changed are not reused.
+
+"""
+
+import logging
+import os
+import time
+import errno
+import hashlib
+import tempfile
+import StringIO
+from collections import OrderedDict
+
+import cairo
+from gi.repository import Gdk
+from gi.repository import GdkPixbuf
+
+from sugar3 import env
+
+from jarabe.journal import model
+
+
+_CACHE_DIR = 'journal-previews'
+
+# Previews kept in memory
+_MEMORY_CACHE_SIZE = 20
+
+# Previews kept on disk, the ones used least recently are removed
+_DISK_CACHE_SIZE = 500
+
+# Previews written between checks of the size of the disk cache
+_PRUNE_INTERVAL = 50
+
+_pixbufs = OrderedDict()
+_writes_since_prune = _PRUNE_INTERVAL
+
+
+def get_pixbuf(metadata, width, height):
+    """Return the preview of an entry scaled to fit width and height
+
+    Returns None if the entry has no preview or it can't be decoded.
+    """
+    key = _get_key(metadata, width, height)
+
+    pixbuf = _pixbufs.pop(key, None)
+    if pixbuf is not None:
+        # Move it to the end, as the most recently used
+        _pixbufs[key] = pixbuf
+        return pixbuf
+
+    cache_path = os.path.join(env.get_profile_path(_CACHE_DIR),
+                              key + '.png')
+    try:
+        pixbuf = GdkPixbuf.Pixbuf.new_from_file(cache_path)
+    except Exception:
+        # Not cached yet, or unreadable
+        pixbuf = None
+    else:
+        try:
+            # Keep track of when it was used last, for pruning
+            os.utime(cache_path, None)
+        except OSError:
+            pass
+
+    if pixbuf is None:
+        surface = _scale_preview(model.get_preview(metadata), width, height)
+        if surface is None:
+            return None
+        _write_surface(surface, cache_path)
+        pixbuf = Gdk.pixbuf_get_from_surface(surface, 0, 0, width, height)
+
+    _pixbufs[key] = pixbuf
+    if len(_pixbufs) > _MEMORY_CACHE_SIZE:
+        _pixbufs.popitem(last=False)
+    return pixbuf
+
+
+def _get_key(metadata, width, height):
+    modified = metadata.get('mtime') or metadata.get('timestamp', '')
+    return hashlib.sha1('%s %s %dx%d' % (metadata.get('uid', ''), modified,
+                                         width, height)).hexdigest()
+
+
+def _scale_preview(preview_data, width, height):
+    if preview_data is None or len(preview_data) <= 4:
+        return None
+
+    if preview_data[1:4] != 'PNG':
+        # TODO: We are close to be able to drop this.
+        import base64
+        preview_data = base64.b64decode(preview_data)
+
+    png_file = StringIO.StringIO(preview_data)
+    try:
+        surface = cairo.ImageSurface.create_from_png(png_file)
+    except Exception:
+        logging.exception('Error while loading the preview')
+        return None
+
+    png_width = surface.get_width()
+    png_height = surface.get_height()
+
+    preview_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+    cr = cairo.Context(preview_surface)
+
+    scale_w = width * 1.0 / png_width
+    scale_h = height * 1.0 / png_height
+    scale = min(scale_w, scale_h)
+
+    cr.scale(scale, scale)
+
+    cr.set_source_rgba(1, 1, 1, 0)
+    cr.set_operator(cairo.OPERATOR_SOURCE)
+    cr.paint()
+    cr.set_source_surface(surface)
+    cr.paint()
+
+    return preview_surface
+
+
+def _write_surface(surface, cache_path):
+    global _writes_since_prune
+
+    cache_dir = os.path.dirname(cache_path)
+    try:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        fd, temp_path = tempfile.mkstemp(dir=cache_dir)
+        try:
+            surface.write_to_png(os.fdopen(fd, 'wb'))
+        except Exception:
+            os.unlink(temp_path)
+            raise
+        os.rename(temp_path, cache_path)
+    except Exception:
+        logging.exception('Could not cache the preview in %r', cache_path)
+        return
+
+    _writes_since_prune += 1
+    if _writes_since_prune >= _PRUNE_INTERVAL:
+        _writes_since_prune = 0
+        _prune(cache_dir)
+
+
+def _prune(cache_dir):
+    """Remove the previews used least recently beyond _DISK_CACHE_SIZE"""
+    t = time.time()
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        try:
+            entries.append((os.stat(path).st_mtime, path))
+        except OSError:
+            continue
+
+    entries.sort(reverse=True)
+    for mtime_, path in entries[_DISK_CACHE_SIZE:]:
+        try:
+            os.unlink(path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                logging.error('Could not remove cached preview %r: %s',
+                              path, e)
+
+    logging.debug('Pruning the preview cache took %f s.', time.time() - t)
@@ -0,0 +1,474 @@
+# Copyright (C) 2012 One Laptop Per Child
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Persistent index of the files stored on a removable volume.
+
+The index lives in the volume's .Sugar-Metadata directory and records, for
+every regular file found while scanning, its inode, mtime, size, guessed
+MIME type and the searchable properties of its Journal metadata. Directory
+listings are recorded together with the mtimes of the directory and of its
+.Sugar-Metadata subdirectory, so that a later scan can reuse the listing of
+every directory that has not changed since, together with the MIME types
+and metadata of the files in it that were not modified in place.
+
+The words in the names of the files and in the text properties of their
+metadata are indexed too, so text searches on the volume look up the
+files containing each word instead of matching every file against the
+query.
+
+Loading and saving the index happen in a thread, so big volumes don't
+block the user interface while their index is read or written.
+
+"""
+
+import logging
+import os
+import re
+import errno
+import time
+import bisect
+import tempfile
+import threading
+from collections import namedtuple
+
+import simplejson
+
+from jarabe.util.normalize import normalize_string
+
+
+INDEX_DIR = 'index'
+INDEX_FILE = 'volume.json'
+
+# Properties of the Journal metadata that are kept in the index so that
+# queries can be answered without reading the .metadata files. The
+# fulltext is too big to be kept, only its words are.
+INDEXED_PROPERTIES = ['activity', 'bundle_id', 'description', 'keep',
+                      'mime_type', 'tags', 'timestamp', 'title']
+
+# How much a word found in each of these counts when ranking the results
+# of a search. Words in the names of the directories count the least.
+_TERM_WEIGHTS = {'title': 4, 'tags': 3, 'description': 2, 'fulltext': 1}
+_FILE_NAME_WEIGHT = 4
+_DIRECTORY_WEIGHT = 1
+
+# Underscores join words in file names, like in photo_beach.png
+_WORD_RE = re.compile(r'[^\W_]+', re.UNICODE)
+
+_INDEX_VERSION = 4
+
+# Directory mtimes on FAT have a resolution of two seconds, so a listing
+# taken within that window of the last change can't be trusted later on.
+_MTIME_RESOLUTION = 2
+
+_indexes = {}
+
+
+FileStat = namedtuple('FileStat', ['st_mode', 'st_ino', 'st_dev', 'st_size',
+                                   'st_mtime'])
+
+Query = namedtuple('Query', ['words', 'prefix'])
+
+
+class IndexEntry(object):
+    """What the index knows about a file or directory on the volume"""
+
+    __slots__ = ['stat', 'mime_type', 'metadata', 'terms']
+
+    def __init__(self, stat, mime_type=None, metadata=None, terms=None):
+        self.stat = stat
+        self.mime_type = mime_type
+        self.metadata = metadata
+        self.terms = terms
+
+
+class VolumeIndex(object):
+    """Index of the files on the volume mounted at mount_point
+
+    Paths are stored relative to the mount point so the index stays valid
+    if the volume gets mounted somewhere else next time.
+    """
+
+    def __init__(self, mount_point, metadata_dir):
+        self._mount_point = mount_point
+        self._path = os.path.join(mount_point, metadata_dir, INDEX_DIR,
+                                  INDEX_FILE)
+        self._directories = {}
+        self._files = {}
+        self._postings = {}
+        self._sorted_terms = None
+        self._dirty = False
+        self._loaded_mtime = None
+        self._device = None
+        self._loaded = threading.Event()
+        self._save_lock = threading.Lock()
+
+    def _get_relative_path(self, path):
+        return os.path.relpath(path, self._mount_point)
+
+    def is_stale(self):
+        """Whether the index file changed on disk since we loaded it"""
+        if not self._loaded.is_set():
+            return False
+        try:
+            mtime = os.stat(self._path).st_mtime
+        except OSError:
+            mtime = None
+        return mtime != self._loaded_mtime
+
+    def start_loading(self):
+        """Load the index in a thread, see is_loaded()"""
+        thread = threading.Thread(target=self.load)
+        thread.daemon = True
+        thread.start()
+
+    def is_loaded(self):
+        return self._loaded.is_set()
+
+    def load(self):
+        try:
+            self._load()
+        finally:
+            self._loaded.set()
+
+    def _load(self):
+        self._directories = {}
+        self._files = {}
+        self._postings = {}
+        self._sorted_terms = None
+        self._dirty = False
+        self._loaded_mtime = None
+
+        try:
+            self._device = os.stat(self._mount_point).st_dev
+            index_file = open(self._path)
+            try:
+                self._loaded_mtime = os.fstat(index_file.fileno()).st_mtime
+                data = simplejson.load(index_file)
+            finally:
+                index_file.close()
+        except EnvironmentError, e:
+            if e.errno != errno.ENOENT:
+                logging.error('Could not read index of volume %r: %s',
+                              self._mount_point, e)
+            return
+        except ValueError:
+            logging.error('Discarding corrupted index of volume %r',
+                          self._mount_point)
+            return
+
+        if data.get('version') != _INDEX_VERSION:
+            logging.debug('Discarding index of volume %r with version %r',
+                          self._mount_point, data.get('version'))
+            return
+
+        # Paths are byte strings everywhere else, like os.listdir() returns
+        for path, record in data['directories'].iteritems():
+            mtime, metadata_mtime, names = record
+            names = [name.encode('utf-8') for name in names]
+            self._directories[path.encode('utf-8')] = \
+                    [mtime, metadata_mtime, names]
+
+        for path, record in data['files'].iteritems():
+            mode, inode, size, mtime, mime_type, metadata, terms = record
+            stat = FileStat(mode, inode, self._device, size, mtime)
+            path = path.encode('utf-8')
+            self._files[path] = IndexEntry(stat, mime_type, metadata, terms)
+            self._add_postings(path, terms)
+
+        logging.debug('Loaded index of volume %r with %d files',
+                      self._mount_point, len(self._files))
+
+    def save(self):
+        """Write the index back to the volume, in a thread"""
+        if not self._dirty:
+            return
+
+        # Entries are replaced, never modified, so copying the dicts is
+        # enough for the thread to see a consistent snapshot
+        thread = threading.Thread(target=self._write,
+                                  args=(dict(self._directories),
+                                        dict(self._files)))
+        thread.daemon = True
+        self._dirty = False
+        thread.start()
+
+    def _write(self, directories, entries):
+        self._save_lock.acquire()
+        try:
+            self._write_locked(directories, entries)
+        finally:
+            self._save_lock.release()
+
+    def _write_locked(self, directories, entries):
+        files = {}
+        for path, entry in entries.iteritems():
+            stat = entry.stat
+            files[path] = [stat.st_mode, stat.st_ino, stat.st_size,
+                           stat.st_mtime, entry.mime_type, entry.metadata,
+                           entry.terms]
+        data = {'version': _INDEX_VERSION,
+                'directories': directories,
+                'files': files}
+
+        index_dir = os.path.dirname(self._path)
+        try:
+            if not os.path.exists(index_dir):
+                os.makedirs(index_dir)
+            fd, temp_path = tempfile.mkstemp(dir=index_dir)
+            try:
+                os.write(fd, simplejson.dumps(data))
+            finally:
+                os.close(fd)
+            os.rename(temp_path, self._path)
+            self._loaded_mtime = os.stat(self._path).st_mtime
+        except (EnvironmentError, UnicodeDecodeError), e:
+            # Read-only or full volumes just don't get a persistent index
+            logging.debug('Could not write index of volume %r: %s',
+                          self._mount_point, e)
+
+    def get_directory(self, dir_path, mtime, metadata_mtime):
+        """Return the names in dir_path if its recorded listing is current
+
+        Returns None if the directory is not in the index or has changed.
+        """
+        record = self._directories.get(self._get_relative_path(dir_path))
+        if record is None:
+            return None
+        recorded_mtime, recorded_metadata_mtime, names = record
+        if recorded_mtime != mtime or \
+                recorded_metadata_mtime != metadata_mtime:
+            return None
+        return names
+
+    def set_directory(self, dir_path, mtime, metadata_mtime, names):
+        relative_path = self._get_relative_path(dir_path)
+
+        old_record = self._directories.get(relative_path)
+        if old_record is not None:
+            for name in set(old_record[2]) - set(names):
+                self.remove_file(os.path.join(dir_path, name))
+
+        if max(mtime, metadata_mtime) > time.time() - _MTIME_RESOLUTION:
+            # Too recent, it could still change without the mtime moving
+            self._directories.pop(relative_path, None)
+        else:
+            self._directories[relative_path] = [mtime, metadata_mtime, names]
+        self._dirty = True
+
+    def get_file(self, path):
+        return self._files.get(self._get_relative_path(path))
+
+    def set_file(self, path, stat, mime_type=None, metadata=None,
+                 terms=None):
+        relative_path = self._get_relative_path(path)
+        if terms is None:
+            terms = get_terms(relative_path, metadata)
+        if metadata is not None:
+            metadata = dict([(key, metadata[key]) \
+                                 for key in INDEXED_PROPERTIES \
+                                 if key in metadata])
+        stat = FileStat(stat.st_mode, stat.st_ino, stat.st_dev,
+                        stat.st_size, int(stat.st_mtime))
+
+        old_entry = self._files.get(relative_path)
+        if old_entry is not None:
+            self._remove_postings(relative_path, old_entry.terms)
+        self._files[relative_path] = IndexEntry(stat, mime_type, metadata,
+                                                terms)
+        self._add_postings(relative_path, terms)
+        self._dirty = True
+
+    def remove_file(self, path):
+        relative_path = self._get_relative_path(path)
+        entry = self._files.pop(relative_path, None)
+        if entry is not None:
+            self._remove_postings(relative_path, entry.terms)
+            self._dirty = True
+
+    def _add_postings(self, relative_path, terms):
+        for term, weight in terms.iteritems():
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = {}
+                self._sorted_terms = None
+            postings[relative_path] = weight
+
+    def _remove_postings(self, relative_path, terms):
+        for term in terms:
+            postings = self._postings.get(term)
+            if postings is None:
+                continue
+            postings.pop(relative_path, None)
+            if not postings:
+                del self._postings[term]
+                self._sorted_terms = None
+
+    def _get_matching_terms(self, word, prefix):
+        if not prefix:
+            if word in self._postings:
+                return [word]
+            return []
+
+        if self._sorted_terms is None:
+            self._sorted_terms = sorted(self._postings)
+        terms = []
+        position = bisect.bisect_left(self._sorted_terms, word)
+        while position < len(self._sorted_terms) and \
+                self._sorted_terms[position].startswith(word):
+            terms.append(self._sorted_terms[position])
+            position += 1
+        return terms
+
+    def search(self, query):
+        """Return the files that contain all the words of query
+
+        The result is a list of (path, score) tuples, with the files that
+        match best first.
+        """
+        scores = None
+        for word in query.words:
+            word_scores = {}
+            for term in self._get_matching_terms(word, query.prefix):
+                for relative_path, weight in \
+                        self._postings[term].iteritems():
+                    weight = _get_match_weight(word, term, weight)
+                    if weight > word_scores.get(relative_path, 0):
+                        word_scores[relative_path] = weight
+
+            if scores is None:
+                scores = word_scores
+            else:
+                scores = dict([(relative_path, score + \
+                                    word_scores[relative_path]) \
+                                   for relative_path, score \
+                                   in scores.iteritems() \
+                                   if relative_path in word_scores])
+            if not scores:
+                return []
+
+        if scores is None:
+            return []
+        hits = [(os.path.join(self._mount_point, relative_path), score) \
+                    for relative_path, score in scores.iteritems()]
+        hits.sort(key=lambda hit: hit[1], reverse=True)
+        return hits
+
+    def prune(self, visited_directories):
+        """Forget about the directories that were not found while scanning"""
+        visited = set([self._get_relative_path(path) \
+                           for path in visited_directories])
+        for relative_path in self._directories.keys():
+            if relative_path in visited:
+                continue
+            names = self._directories.pop(relative_path)[2]
+            dir_path = os.path.join(self._mount_point, relative_path)
+            for name in names:
+                self.remove_file(os.path.join(dir_path, name))
+            self._dirty = True
+
+
+def _tokenize(text):
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+    elif not isinstance(text, unicode):
+        text = unicode(text)
+
+    for word in _WORD_RE.findall(text):
+        normalized = normalize_string(word)
+        if normalized:
+            for token in _WORD_RE.findall(normalized):
+                yield token
+        else:
+            # Scripts without an ASCII equivalent are indexed as written
+            yield word.lower()
+
+
+def get_terms(relative_path, metadata):
+    """Return the words to index for a file, with their weights"""
+    terms = {}
+
+    def add_terms(text, weight):
+        for term in _tokenize(text):
+            if weight > terms.get(term, 0):
+                terms[term] = weight
+
+    directory, file_name = os.path.split(relative_path)
+    add_terms(directory, _DIRECTORY_WEIGHT)
+    add_terms(file_name, _FILE_NAME_WEIGHT)
+    if metadata:
+        for key, weight in _TERM_WEIGHTS.iteritems():
+            if metadata.get(key):
+                add_terms(metadata[key], weight)
+    return terms
+
+
+def parse_query(query_text):
+    """Return the Query for the text typed in the search entry
+
+    Like in the datastore, each word matches the words starting with it,
+    unless the text is quoted.
+    """
+    query_text = query_text.strip()
+    prefix = True
+    if len(query_text) > 1 and query_text.startswith('"') and \
+            query_text.endswith('"'):
+        query_text = query_text[1:-1]
+        prefix = False
+    words = []
+    for word in _tokenize(query_text):
+        if word not in words:
+            words.append(word)
+    return Query(words, prefix)
+
+
+def get_score(terms, query):
+    """Return how well a file with terms matches query, 0 if it doesn't"""
+    score = 0
+    for word in query.words:
+        best_weight = 0
+        if query.prefix:
+            for term, weight in terms.iteritems():
+                if term.startswith(word):
+                    best_weight = max(best_weight,
+                                      _get_match_weight(word, term, weight))
+        elif word in terms:
+            best_weight = _get_match_weight(word, word, terms[word])
+        if not best_weight:
+            return 0
+        score += best_weight
+    return score
+
+
+def _get_match_weight(word, term, weight):
+    # Whole words count more than words that only start with the query
+    if term == word:
+        return weight * 2
+    return weight
+
+
+def get_index(mount_point, metadata_dir):
+    """Return the index for the volume mounted at mount_point
+
+    The index is kept inside metadata_dir at the root of the volume. It
+    gets loaded in a thread, check is_loaded() before using it.
+    """
+    index = _indexes.get(mount_point)
+    if index is None or index.is_stale():
+        index = VolumeIndex(mount_point, metadata_dir)
+        index.start_loading()
+        _indexes[mount_point] = index
+    return index
+
@@ -16,7 +16,6 @@
 
 import logging
 import os
-import statvfs
 from gettext import gettext as _
 
 from gi.repository import GObject
@@ -30,18 +29,34 @@ import xapian
 import simplejson
 import tempfile
 import shutil
+import threading
+import Queue
 
 from sugar3.graphics.radiotoolbutton import RadioToolButton
 from sugar3.graphics.palette import Palette
+from sugar3.graphics.palettemenu import PaletteMenuItemSeparator
 from sugar3.graphics.xocolor import XoColor
-from sugar3 import env
+from sugar3.graphics import style
 
 from jarabe.journal import model
+from jarabe.journal import journalwindow
 from jarabe.view.palettes import VolumePalette
+from jarabe.view.palettes import FreeSpaceBox
 
 
 _JOURNAL_0_METADATA_DIR = '.olpc.store'
 
+# Files in the Journal metadata directory of a volume that record how far
+# the conversion of its DS-0 entries got, and that it is done
+_DS0_PROGRESS_FILE = 'ds0-conversion'
+_DS0_DONE_FILE = 'ds0-converted'
+
+# Entries converted between two records of the progress
+_CONVERSION_BATCH_SIZE = 50
+
+# How often, in milliseconds, the main loop checks the progress
+_CONVERSION_POLL_INTERVAL = 250
+
 
 def _get_id(document):
     """Get the ID for the document in the xapian database."""
@@ -55,7 +70,7 @@ def _get_id(document):
         return None
 
 
-def _convert_entries(root):
+class _Conversion(GObject.GObject):
     """Convert entries written by the datastore version 0.
 
     The metadata and the preview will be written using the new
@@ -68,32 +83,177 @@ def _convert_entries(root):
     the file accordingly, taking care of creating a unique
     filename
 
+    The entries are converted by a thread so the shell keeps responding
+    on volumes with many of them. After every batch the last document
+    converted is recorded on the volume, so an interrupted conversion
+    resumes where it stopped, and once all are done a marker file is
+    written so the volume is skipped the next time it is mounted.
+
     """
-    try:
-        database = xapian.Database(os.path.join(root, _JOURNAL_0_METADATA_DIR,
-                                                'index'))
-    except xapian.DatabaseError:
-        logging.exception('Convert DS-0 Journal entries: error reading db: %s',
-                      os.path.join(root, _JOURNAL_0_METADATA_DIR, 'index'))
-        return
 
-    metadata_dir_path = os.path.join(root, model.JOURNAL_METADATA_DIR)
-    if not os.path.exists(metadata_dir_path):
+    __gsignals__ = {
+        'progress': (GObject.SignalFlags.RUN_FIRST, None,
+                     ([int, int])),
+        'finished': (GObject.SignalFlags.RUN_FIRST, None,
+                     ([])),
+    }
+
+    def __init__(self, root):
+        GObject.GObject.__init__(self)
+
+        self.root = root
+        self.converted = 0
+        self.total = 0
+
+        metadata_dir_path = os.path.join(root, model.JOURNAL_METADATA_DIR)
+        self._progress_path = os.path.join(metadata_dir_path,
+                                           _DS0_PROGRESS_FILE)
+        self._done_path = os.path.join(metadata_dir_path, _DS0_DONE_FILE)
+
+        self._updates = Queue.Queue()
+        self._stopped = False
+        self._poll_hid = None
+
+    @staticmethod
+    def is_needed(root):
+        return os.path.exists(os.path.join(root, _JOURNAL_0_METADATA_DIR)) \
+            and not os.path.exists(os.path.join(root,
+                                                model.JOURNAL_METADATA_DIR,
+                                                _DS0_DONE_FILE))
+
+    def start(self):
+        logging.debug('Convert DS-0 Journal entries: starting conversion')
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+        self._poll_hid = GObject.timeout_add(_CONVERSION_POLL_INTERVAL,
+                                             self.__poll_cb)
+
+    def stop(self):
+        self._stopped = True
+        if self._poll_hid is not None:
+            GObject.source_remove(self._poll_hid)
+            self._poll_hid = None
+
+    def __poll_cb(self):
+        progress = None
+        finished = False
         try:
-            os.mkdir(metadata_dir_path)
-        except EnvironmentError:
-            logging.error('Convert DS-0 Journal entries: '
-                          'error creating the Journal metadata directory.')
+            while True:
+                update = self._updates.get_nowait()
+                if update is None:
+                    finished = True
+                else:
+                    progress = update
+        except Queue.Empty:
+            pass
+
+        if progress is not None:
+            self.converted, self.total = progress
+            self.emit('progress', self.converted, self.total)
+
+        if finished:
+            self._poll_hid = None
+            self.emit('finished')
+            return False
+        return True
+
+    def _run(self):
+        try:
+            self._convert_entries()
+        except Exception:
+            logging.exception('Convert DS-0 Journal entries: error converting '
+                              'the entries in %r', self.root)
+        self._updates.put(None)
+
+    def _convert_entries(self):
+        index_path = os.path.join(self.root, _JOURNAL_0_METADATA_DIR, 'index')
+        try:
+            database = xapian.Database(index_path)
+        except xapian.DatabaseError:
+            logging.exception('Convert DS-0 Journal entries: error reading '
+                              'db: %s', index_path)
             return
 
-    for posting_item in database.postlist(''):
+        metadata_dir_path = os.path.join(self.root,
+                                         model.JOURNAL_METADATA_DIR)
+        if not os.path.exists(metadata_dir_path):
+            try:
+                os.mkdir(metadata_dir_path)
+            except EnvironmentError:
+                logging.error('Convert DS-0 Journal entries: '
+                              'error creating the Journal metadata directory.')
+                return
+
+        last_docid = self._read_progress()
+        total = database.get_doccount()
+        converted = 0
+        docid = None
+
+        # Documents are listed in increasing order of docid
+        for posting_item in database.postlist(''):
+            if self._stopped:
+                return
+
+            converted += 1
+            if posting_item.docid <= last_docid:
+                continue
+            docid = posting_item.docid
+
+            try:
+                document = database.get_document(docid)
+            except xapian.DocNotFoundError, e:
+                logging.debug('Convert DS-0 Journal entries: error getting '
+                              'document %s: %s', docid, e)
+                continue
+
+            try:
+                _convert_entry(self.root, document)
+            except EnvironmentError, e:
+                logging.error('Convert DS-0 Journal entries: error converting '
+                              'document %s: %s', docid, e)
+
+            if converted % _CONVERSION_BATCH_SIZE == 0:
+                self._write_progress(docid)
+                self._updates.put((converted, total))
+
+        self._updates.put((converted, total))
         try:
-            document = database.get_document(posting_item.docid)
-        except xapian.DocNotFoundError, e:
-            logging.debug('Convert DS-0 Journal entries: error getting '
-                          'document %s: %s', posting_item.docid, e)
-            continue
-        _convert_entry(root, document)
+            open(self._done_path, 'w').close()
+        except EnvironmentError, e:
+            logging.error('Convert DS-0 Journal entries: error marking the '
+                          'conversion as done: %s', e)
+            if docid is not None:
+                self._write_progress(docid)
+            return
+
+        try:
+            os.remove(self._progress_path)
+        except OSError:
+            pass
+        logging.debug('Convert DS-0 Journal entries: %d entries in %r '
+                      'converted', converted, self.root)
+
+    def _read_progress(self):
+        try:
+            progress_file = open(self._progress_path)
+            try:
+                return int(progress_file.read())
+            finally:
+                progress_file.close()
+        except (EnvironmentError, ValueError):
+            return 0
+
+    def _write_progress(self, docid):
+        try:
+            fd, temp_path = tempfile.mkstemp(
+                dir=os.path.dirname(self._progress_path))
+            os.write(fd, str(docid))
+            os.close(fd)
+            os.rename(temp_path, self._progress_path)
+        except EnvironmentError, e:
+            logging.error('Convert DS-0 Journal entries: error recording '
+                          'the progress: %s', e)
 
 
 def _convert_entry(root, document):
@@ -168,12 +328,15 @@ class VolumesToolbar(Gtk.Toolbar):
                            ([str])),
         'volume-error': (GObject.SignalFlags.RUN_FIRST, None,
                          ([str, str])),
+        'volume-converted': (GObject.SignalFlags.RUN_FIRST, None,
+                             ([str])),
     }
 
     def __init__(self):
         Gtk.Toolbar.__init__(self)
         self._mount_added_hid = None
         self._mount_removed_hid = None
+        self._conversions = {}
 
         button = JournalButton()
         button.connect('toggled', self._button_toggled_cb)
@@ -186,6 +349,10 @@ class VolumesToolbar(Gtk.Toolbar):
         GObject.idle_add(self._set_up_volumes)
 
     def __destroy_cb(self, widget):
+        for conversion in self._conversions.values():
+            conversion.stop()
+        self._conversions = {}
+
         volume_monitor = Gio.VolumeMonitor.get()
         volume_monitor.disconnect(self._mount_added_hid)
         volume_monitor.disconnect(self._mount_removed_hid)
@@ -226,11 +393,6 @@ class VolumesToolbar(Gtk.Toolbar):
     def _add_button(self, mount):
         logging.debug('VolumeToolbar._add_button: %r', mount.get_name())
 
-        if os.path.exists(os.path.join(mount.get_root().get_path(),
-                                       _JOURNAL_0_METADATA_DIR)):
-            logging.debug('Convert DS-0 Journal entries: starting conversion')
-            GObject.idle_add(_convert_entries, mount.get_root().get_path())
-
         button = VolumeButton(mount)
         button.props.group = self._volume_buttons[0]
         button.connect('toggled', self._button_toggled_cb)
@@ -244,6 +406,18 @@ class VolumesToolbar(Gtk.Toolbar):
         if len(self.get_children()) > 1:
             self.show()
 
+        mount_point = mount.get_root().get_path()
+        if _Conversion.is_needed(mount_point):
+            conversion = _Conversion(mount_point)
+            conversion.connect('finished', self.__conversion_finished_cb)
+            button.set_conversion(conversion)
+            self._conversions[mount_point] = conversion
+            conversion.start()
+
+    def __conversion_finished_cb(self, conversion):
+        del self._conversions[conversion.root]
+        self.emit('volume-converted', conversion.root)
+
     def __volume_error_cb(self, button, strerror, severity):
         self.emit('volume-error', strerror, severity)
 
@@ -260,6 +434,10 @@ class VolumesToolbar(Gtk.Toolbar):
         return None
 
     def _remove_button(self, mount):
+        conversion = self._conversions.pop(mount.get_root().get_path(), None)
+        if conversion is not None:
+            conversion.stop()
+
         button = self._get_button_for_mount(mount)
         self._volume_buttons.remove(button)
         self.remove(button)
@@ -292,27 +470,17 @@ class BaseButton(RadioToolButton):
     def _drag_data_received_cb(self, widget, drag_context, x, y,
                                selection_data, info, timestamp):
         object_id = selection_data.data
-        metadata = model.get(object_id)
-        file_path = model.get_file(metadata['uid'])
-        if not file_path or not os.path.exists(file_path):
-            logging.warn('Entries without a file cannot be copied.')
-            self.emit('volume-error',
-                      _('Entries without a file cannot be copied.'),
-                      _('Warning'))
-            return
-
-        try:
-            model.copy(metadata, self.mount_point)
-        except IOError, e:
-            logging.exception('Error while copying the entry. %s', e.strerror)
-            self.emit('volume-error',
-                      _('Error while copying the entry. %s') % e.strerror,
-                      _('Error'))
+        journalwindow.get_journal_window().copy_entries([object_id],
+                                                        self.mount_point)
 
 
 class VolumeButton(BaseButton):
     def __init__(self, mount):
         self._mount = mount
+        self._conversion = None
+        self._conversion_box = None
+        self._conversion_bar = None
+        self._conversion_label = None
         mount_point = mount.get_root().get_path()
         BaseButton.__init__(self, mount_point)
 
@@ -334,12 +502,69 @@ class VolumeButton(BaseButton):
         color = XoColor(client.get_string('/desktop/sugar/user/color'))
         self.props.xo_color = color
 
+    def set_conversion(self, conversion):
+        """Show the progress of the conversion of the DS-0 entries"""
+        self._conversion = conversion
+        conversion.connect('progress', self.__conversion_progress_cb)
+        conversion.connect('finished', self.__conversion_finished_cb)
+
     def create_palette(self):
         palette = VolumePalette(self._mount)
         #palette.props.invoker = FrameWidgetInvoker(self)
         #palette.set_group_id('frame')
+
+        if self._conversion is not None:
+            self._conversion_box = Gtk.VBox()
+            self._conversion_box.set_spacing(style.DEFAULT_PADDING)
+            palette.content_box.append_item(self._conversion_box,
+                                            vertical_padding=0)
+            self._conversion_box.show()
+
+            separator = PaletteMenuItemSeparator()
+            self._conversion_box.pack_start(separator, True, True, 0)
+            separator.show()
+
+            self._conversion_bar = Gtk.ProgressBar()
+            self._conversion_box.pack_start(self._conversion_bar, True, True,
+                                            0)
+            self._conversion_bar.show()
+
+            self._conversion_label = Gtk.Label()
+            self._conversion_label.set_alignment(0.5, 0.5)
+            self._conversion_box.pack_start(self._conversion_label, True,
+                                            True, 0)
+            self._conversion_label.show()
+
+            self._update_conversion_progress()
+
         return palette
 
+    def _update_conversion_progress(self):
+        if self._conversion_box is None:
+            return
+
+        converted = self._conversion.converted
+        total = self._conversion.total
+        if total:
+            self._conversion_bar.props.fraction = converted / float(total)
+            self._conversion_label.props.label = \
+                    _('Converting entries: %(converted)d of %(total)d') % \
+                    {'converted': converted, 'total': total}
+        else:
+            self._conversion_bar.pulse()
+            self._conversion_label.props.label = _('Converting entries')
+
+    def __conversion_progress_cb(self, conversion, converted, total):
+        self._update_conversion_progress()
+
+    def __conversion_finished_cb(self, conversion):
+        self._conversion = None
+        if self._conversion_box is not None:
+            self._conversion_box.destroy()
+            self._conversion_box = None
+            self._conversion_bar = None
+            self._conversion_label = None
+
 
 class JournalButton(BaseButton):
     def __init__(self):
@@ -360,30 +585,9 @@ class JournalButtonPalette(Palette):
 
     def __init__(self, mount):
         Palette.__init__(self, glib.markup_escape_text(_('Journal')))
-        vbox = Gtk.VBox()
-        self.set_content(vbox)
-        vbox.show()
-
-        self._progress_bar = Gtk.ProgressBar()
-        vbox.add(self._progress_bar)
-        self._progress_bar.show()
-
-        self._free_space_label = Gtk.Label()
-        self._free_space_label.set_alignment(0.5, 0.5)
-        vbox.add(self._free_space_label)
-        self._free_space_label.show()
-
-        self.connect('popup', self.__popup_cb)
-
-    def __popup_cb(self, palette):
-        stat = os.statvfs(env.get_profile_path())
-        free_space = stat[statvfs.F_BSIZE] * stat[statvfs.F_BAVAIL]
-        total_space = stat[statvfs.F_BSIZE] * stat[statvfs.F_BLOCKS]
-
-        fraction = (total_space - free_space) / float(total_space)
-        self._progress_bar.props.fraction = fraction
-        self._free_space_label.props.label = _('%(free_space)d MB Free') % \
-                {'free_space': free_space / (1024 * 1024)}
+        free_space_box = FreeSpaceBox(self)
+        self.set_content(free_space_box)
+        free_space_box.show()
 
 
 class DocumentsButton(BaseButton):
@@ -16,20 +16,30 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import os
+import errno
 import logging
+import locale
+import tempfile
+import cPickle
+import shutil
+import stat
+import threading
+import zipfile
 
 from gi.repository import GConf
 from gi.repository import GObject
 from gi.repository import Gio
 import simplejson
 
+from sugar3.bundle import activitybundle
 from sugar3.bundle.activitybundle import ActivityBundle
 from sugar3.bundle.contentbundle import ContentBundle
 from sugar3.bundle.bundleversion import NormalizedVersion
 from jarabe.journal.journalentrybundle import JournalEntryBundle
 from sugar3.bundle.bundle import MalformedBundleException, \
-    AlreadyInstalledException, RegistrationException
+    AlreadyInstalledException, RegistrationException, ZipExtractException
 from sugar3 import env
+from sugar3 import mime
 
 from jarabe import config
 from jarabe.model import mimeregistry
@@ -37,6 +47,27 @@ from jarabe.model import mimeregistry
 
 _instance = None
 
+# Bumped when the way bundles are cached changes
+_BUNDLE_CACHE_VERSION = 2
+
+# Time, in milliseconds, the favorites have to stay unchanged before they
+# are written
+_FAVORITES_WRITE_DELAY = 1000
+
+# Bundles that are extracted at the same time, the rest wait for their turn
+_INSTALL_WORKERS = 2
+
+# How often, in milliseconds, the main loop checks on the installations
+_INSTALL_POLL_INTERVAL = 100
+
+# Bundles are extracted in directories with this prefix inside the user
+# activities directory, then moved into place
+_INSTALL_STAGING_PREFIX = '.install-'
+
+_INSTALL_BUFFER_SIZE = 64 * 1024
+
+_install_slots = threading.Semaphore(_INSTALL_WORKERS)
+
 
 class BundleRegistry(GObject.GObject):
     """Tracks the available activity bundles"""
@@ -56,10 +87,28 @@ class BundleRegistry(GObject.GObject):
 
         self._mime_defaults = self._load_mime_defaults()
 
+        # The list keeps the order bundles were added in, the dictionaries
+        # index them by bundle id and by path. There is only one bundle for
+        # each bundle id, older versions are replaced when newer ones are
+        # added.
         self._bundles = []
+        self._bundles_by_id = {}
+        self._bundles_by_path = {}
+        # The bundles that can open each MIME type, in the same order
+        self._bundles_by_mime_type = {}
+        self._mime_parents = {}
+        # Installations running, by bundle id and version
+        self._installations = {}
         # hold a reference to the monitors so they don't get disposed
         self._gio_monitors = []
 
+        # Bundles found while scanning, by path, with the mtimes of their
+        # directory and of their activity.info. The ones that did not
+        # change since last time are taken from the cache instead of
+        # parsing their activity.info again.
+        self._cached_bundles = self._load_bundle_cache()
+        self._scanned_bundles = {}
+
         user_path = env.get_user_activities_path()
         for activity_dir in [user_path, config.activities_path]:
             self._scan_directory(activity_dir)
@@ -69,8 +118,14 @@ class BundleRegistry(GObject.GObject):
             monitor.connect('changed', self.__file_monitor_changed_cb)
             self._gio_monitors.append(monitor)
 
+        if self._scanned_bundles != self._cached_bundles:
+            self._write_bundle_cache(self._scanned_bundles)
+        self._cached_bundles = None
+        self._scanned_bundles = None
+
         self._last_defaults_mtime = -1
         self._favorite_bundles = {}
+        self._favorites_write_hid = None
 
         client = GConf.Client.get_default()
         self._protected_activities = []
@@ -108,13 +163,86 @@ class BundleRegistry(GObject.GObject):
         for line in f.readlines():
             line = line.strip()
             if line and not line.startswith('#'):
-                mime = line[:line.find(' ')]
+                mime_type = line[:line.find(' ')]
                 handler = line[line.rfind(' ') + 1:]
-                defaults[mime] = handler
+                defaults[mime_type] = handler
         f.close()
 
         return defaults
 
+    def _get_bundle_cache_key(self):
+        """What the cached bundles depend on besides their directories
+
+        The names of the bundles are translated to the language of the
+        session, and the bundles are cached as they are created by the
+        toolkit.
+        """
+        return (_BUNDLE_CACHE_VERSION, locale.getdefaultlocale(),
+                os.stat(activitybundle.__file__).st_mtime)
+
+    def _load_bundle_cache(self):
+        cache_path = env.get_profile_path('bundle_registry')
+        try:
+            cache_file = open(cache_path, 'rb')
+            try:
+                cache_data = cPickle.load(cache_file)
+            finally:
+                cache_file.close()
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                logging.error('Error reading the bundle registry cache: %s', e)
+            return {}
+        except Exception:
+            logging.exception('Discarding the bundle registry cache')
+            return {}
+
+        if cache_data.get('key') != self._get_bundle_cache_key():
+            logging.debug('Discarding the outdated bundle registry cache')
+            return {}
+        return cache_data['bundles']
+
+    def _write_bundle_cache(self, bundles):
+        cache_path = env.get_profile_path('bundle_registry')
+        cache_data = {'key': self._get_bundle_cache_key(),
+                      'bundles': bundles}
+        try:
+            fd, temp_path = tempfile.mkstemp(
+                dir=os.path.dirname(cache_path))
+            try:
+                cache_file = os.fdopen(fd, 'wb')
+                try:
+                    cPickle.dump(cache_data, cache_file,
+                                 cPickle.HIGHEST_PROTOCOL)
+                finally:
+                    cache_file.close()
+                os.rename(temp_path, cache_path)
+            except Exception:
+                os.unlink(temp_path)
+                raise
+        except Exception:
+            logging.exception('Error writing the bundle registry cache')
+
+    def _load_bundle(self, bundle_path, mtime):
+        """Return the bundle at bundle_path, from the cache if possible
+
+        Editing activity.info in place doesn't change the mtime of the
+        bundle directory, so the mtime of the file counts too.
+        """
+        info_path = os.path.join(bundle_path, 'activity', 'activity.info')
+        try:
+            info_mtime = os.stat(info_path).st_mtime
+        except OSError:
+            info_mtime = None
+        mtimes = (mtime, info_mtime)
+
+        cached = self._cached_bundles.get(bundle_path)
+        if cached is not None and cached[0] == mtimes:
+            bundle = cached[1]
+        else:
+            bundle = ActivityBundle(bundle_path)
+        self._scanned_bundles[bundle_path] = (mtimes, bundle)
+        return bundle
+
     def _get_favorite_key(self, bundle_id, version):
         """We use a string as a composite key for the favorites dictionary
         because JSON doesn't support tuples and python won't accept a list
@@ -164,11 +292,11 @@ class BundleRegistry(GObject.GObject):
 
         for bundle_id in default_activities:
             max_version = '0'
-            for bundle in self._bundles:
-                if bundle.get_bundle_id() == bundle_id and \
-                        NormalizedVersion(max_version) < \
-                        NormalizedVersion(bundle.get_activity_version()):
-                    max_version = bundle.get_activity_version()
+            bundle = self._bundles_by_id.get(bundle_id)
+            if bundle is not None and \
+                    NormalizedVersion(max_version) < \
+                    NormalizedVersion(bundle.get_activity_version()):
+                max_version = bundle.get_activity_version()
 
             key = self._get_favorite_key(bundle_id, max_version)
             if NormalizedVersion(max_version) > NormalizedVersion('0') and \
@@ -177,14 +305,11 @@ class BundleRegistry(GObject.GObject):
 
         logging.debug('After merging: %r', self._favorite_bundles)
 
-        self._write_favorites_file()
+        self._queue_favorites_write()
 
     def get_bundle(self, bundle_id):
         """Returns an bundle given his service name"""
-        for bundle in self._bundles:
-            if bundle.get_bundle_id() == bundle_id:
-                return bundle
-        return None
+        return self._bundles_by_id.get(bundle_id)
 
     def __iter__(self):
         return self._bundles.__iter__()
@@ -199,6 +324,10 @@ class BundleRegistry(GObject.GObject):
         # Sort by mtime to ensure a stable activity order
         bundles = {}
         for f in os.listdir(path):
+            if f.startswith(_INSTALL_STAGING_PREFIX):
+                # Left behind by an installation that was interrupted
+                shutil.rmtree(os.path.join(path, f), ignore_errors=True)
+                continue
             if not f.endswith('.activity'):
                 continue
             try:
@@ -213,7 +342,7 @@ class BundleRegistry(GObject.GObject):
         bundle_dirs.sort(lambda d1, d2: cmp(bundles[d1], bundles[d2]))
         for folder in bundle_dirs:
             try:
-                self._add_bundle(folder)
+                self._add_bundle(folder, mtime=bundles[folder])
             except:
                 # pylint: disable=W0702
                 logging.exception('Error while processing installed activity'
@@ -230,10 +359,13 @@ class BundleRegistry(GObject.GObject):
         else:
             return False
 
-    def _add_bundle(self, bundle_path, install_mime_type=False):
+    def _add_bundle(self, bundle_path, install_mime_type=False, mtime=None):
         logging.debug('STARTUP: Adding bundle %r', bundle_path)
         try:
-            bundle = ActivityBundle(bundle_path)
+            if mtime is not None:
+                bundle = self._load_bundle(bundle_path, mtime)
+            else:
+                bundle = ActivityBundle(bundle_path)
             if install_mime_type:
                 bundle.install_mime_type(bundle_path)
         except MalformedBundleException:
@@ -253,46 +385,75 @@ class BundleRegistry(GObject.GObject):
                 self.remove_bundle(installed.get_path())
 
         self._bundles.append(bundle)
+        self._bundles_by_id[bundle_id] = bundle
+        self._bundles_by_path[bundle.get_path()] = bundle
+        for mime_type in bundle.get_mime_types() or []:
+            self._bundles_by_mime_type.setdefault(mime_type, []).append(bundle)
         return bundle
 
     def remove_bundle(self, bundle_path):
-        for bundle in self._bundles:
-            if bundle.get_path() == bundle_path:
-                self._bundles.remove(bundle)
-                self.emit('bundle-removed', bundle)
-                return True
-        return False
+        bundle = self._bundles_by_path.pop(bundle_path, None)
+        if bundle is None:
+            return False
+
+        self._bundles.remove(bundle)
+        del self._bundles_by_id[bundle.get_bundle_id()]
+        for mime_type in bundle.get_mime_types() or []:
+            bundles = self._bundles_by_mime_type[mime_type]
+            bundles.remove(bundle)
+            if not bundles:
+                del self._bundles_by_mime_type[mime_type]
+        self.emit('bundle-removed', bundle)
+        return True
 
     def get_activities_for_type(self, mime_type):
+        bundles = self._bundles_by_mime_type.get(mime_type)
+        if not bundles:
+            return []
+
         result = []
 
-        mime = mimeregistry.get_registry()
-        default_bundle_id = mime.get_default_activity(mime_type)
+        default_bundle_id = \
+                mimeregistry.get_registry().get_default_activity(mime_type)
         default_bundle = None
+        default_for_type = self.get_default_for_type(mime_type)
 
-        for bundle in self._bundles:
-            if mime_type in (bundle.get_mime_types() or []):
-                if bundle.get_bundle_id() == default_bundle_id:
-                    default_bundle = bundle
-                elif self.get_default_for_type(mime_type) == \
-                        bundle.get_bundle_id():
-                    result.insert(0, bundle)
-                else:
-                    result.append(bundle)
+        for bundle in bundles:
+            if bundle.get_bundle_id() == default_bundle_id:
+                default_bundle = bundle
+            elif default_for_type == bundle.get_bundle_id():
+                result.insert(0, bundle)
+            else:
+                result.append(bundle)
 
         if default_bundle is not None:
             result.insert(0, default_bundle)
 
         return result
 
+    def get_activities_for_type_or_parents(self, mime_type):
+        """Return the activities for mime_type, or for the types it is
+        a subclass of if there are none for mime_type itself.
+        """
+        result = self.get_activities_for_type(mime_type)
+        if not result:
+            parents = self._mime_parents.get(mime_type)
+            if parents is None:
+                parents = self._mime_parents[mime_type] = \
+                        mime.get_mime_parents(mime_type)
+            for parent_mime in parents:
+                for activity in self.get_activities_for_type(parent_mime):
+                    if activity not in result:
+                        result.append(activity)
+        return result
+
     def get_default_for_type(self, mime_type):
         return self._mime_defaults.get(mime_type)
 
     def _find_bundle(self, bundle_id, version):
-        for bundle in self._bundles:
-            if bundle.get_bundle_id() == bundle_id and \
-                    bundle.get_activity_version() == version:
-                return bundle
+        bundle = self._bundles_by_id.get(bundle_id)
+        if bundle is not None and bundle.get_activity_version() == version:
+            return bundle
         raise ValueError('No bundle %r with version %r exists.' % \
                 (bundle_id, version))
 
@@ -311,7 +472,7 @@ class BundleRegistry(GObject.GObject):
         else:
             return False
 
-        self._write_favorites_file()
+        self._queue_favorites_write()
         return True
 
     def is_bundle_favorite(self, bundle_id, version):
@@ -335,7 +496,7 @@ class BundleRegistry(GObject.GObject):
         else:
             return
 
-        self._write_favorites_file()
+        self._queue_favorites_write()
         bundle = self._find_bundle(bundle_id, version)
         self.emit('bundle-changed', bundle)
 
@@ -351,11 +512,50 @@ class BundleRegistry(GObject.GObject):
         else:
             return tuple(self._favorite_bundles[key]['position'])
 
+    def _queue_favorites_write(self):
+        """Write the favorites once they stop changing for a moment
+
+        Moving an icon in the favorites view changes its position many
+        times in a row, this avoids rewriting the file for each of them.
+        """
+        if self._favorites_write_hid is not None:
+            GObject.source_remove(self._favorites_write_hid)
+        self._favorites_write_hid = GObject.timeout_add(
+            _FAVORITES_WRITE_DELAY, self.__favorites_write_cb)
+
+    def __favorites_write_cb(self):
+        self._favorites_write_hid = None
+        self._write_favorites_file()
+        return False
+
+    def flush(self):
+        """Write the changes to the favorites that are still queued"""
+        if self._favorites_write_hid is not None:
+            GObject.source_remove(self._favorites_write_hid)
+            self._favorites_write_hid = None
+            self._write_favorites_file()
+
     def _write_favorites_file(self):
         path = env.get_profile_path('favorite_activities')
         favorites_data = {'defaults-mtime': self._last_defaults_mtime,
                           'favorites': self._favorite_bundles}
-        simplejson.dump(favorites_data, open(path, 'w'), indent=1)
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            try:
+                favorites_file = os.fdopen(fd, 'w')
+                try:
+                    simplejson.dump(favorites_data, favorites_file,
+                                    separators=(',', ':'))
+                    favorites_file.flush()
+                    os.fsync(favorites_file.fileno())
+                finally:
+                    favorites_file.close()
+                os.rename(temp_path, path)
+            except Exception:
+                os.unlink(temp_path)
+                raise
+        except Exception:
+            logging.exception('Error writing favorite_activities')
 
     def is_installed(self, bundle):
         # TODO treat ContentBundle in special way
@@ -364,26 +564,28 @@ class BundleRegistry(GObject.GObject):
                 isinstance(bundle, JournalEntryBundle):
             return bundle.is_installed()
 
-        for installed_bundle in self._bundles:
-            if bundle.get_bundle_id() == installed_bundle.get_bundle_id() and \
-                    NormalizedVersion(bundle.get_activity_version()) == \
-                    NormalizedVersion(installed_bundle.get_activity_version()):
-                return True
-        return False
+        installed_bundle = self._bundles_by_id.get(bundle.get_bundle_id())
+        return installed_bundle is not None and \
+                NormalizedVersion(bundle.get_activity_version()) == \
+                NormalizedVersion(installed_bundle.get_activity_version())
+
+    def _get_bundle_to_replace(self, bundle, force_downgrade):
+        """Return the installed bundle that installing bundle replaces
+
+        Raises AlreadyInstalledException if the same or a newer version is
+        installed, unless force_downgrade is set.
+        """
+        installed_bundle = self._bundles_by_id.get(bundle.get_bundle_id())
+        if installed_bundle is not None and not force_downgrade and \
+                NormalizedVersion(bundle.get_activity_version()) <= \
+                NormalizedVersion(installed_bundle.get_activity_version()):
+            raise AlreadyInstalledException
+        return installed_bundle
 
     def install(self, bundle, uid=None, force_downgrade=False):
-        activities_path = env.get_user_activities_path()
-
-        for installed_bundle in self._bundles:
-            if bundle.get_bundle_id() == installed_bundle.get_bundle_id() and \
-                    NormalizedVersion(bundle.get_activity_version()) <= \
-                    NormalizedVersion(installed_bundle.get_activity_version()):
-                if not force_downgrade:
-                    raise AlreadyInstalledException
-                else:
-                    self.uninstall(installed_bundle, force=True)
-            elif bundle.get_bundle_id() == installed_bundle.get_bundle_id():
-                self.uninstall(installed_bundle, force=True)
+        installed_bundle = self._get_bundle_to_replace(bundle, force_downgrade)
+        if installed_bundle is not None:
+            self.uninstall(installed_bundle, force=True)
 
         install_dir = env.get_user_activities_path()
         if isinstance(bundle, JournalEntryBundle):
@@ -401,6 +603,76 @@ class BundleRegistry(GObject.GObject):
         elif not self.add_bundle(install_path):
             raise RegistrationException
 
+    def install_async(self, bundle, uid=None, force_downgrade=False):
+        """Install bundle without blocking the main loop
+
+        Returns an Installation that emits 'progress' while the bundle is
+        extracted and 'finished' when it is installed or failed. Raises
+        AlreadyInstalledException like install() does.
+        """
+        self._get_bundle_to_replace(bundle, force_downgrade)
+
+        if not isinstance(bundle, ActivityBundle):
+            installation = Installation(bundle, force_downgrade)
+            try:
+                self.install(bundle, uid, force_downgrade)
+            except Exception, e:
+                logging.exception('Error installing bundle %r',
+                                  bundle.get_path())
+                installation.error = e
+            # Give the caller the chance to connect to the signals
+            GObject.idle_add(installation.finish)
+            return installation
+
+        key = (bundle.get_bundle_id(), bundle.get_activity_version())
+        installation = self._installations.get(key)
+        if installation is not None:
+            return installation
+
+        installation = Installation(bundle, force_downgrade)
+        installation.connect('extracted', self.__bundle_extracted_cb)
+        self._installations[key] = installation
+        installation.start()
+        return installation
+
+    def __bundle_extracted_cb(self, installation):
+        bundle = installation.bundle
+        del self._installations[(bundle.get_bundle_id(),
+                                 bundle.get_activity_version())]
+
+        if installation.error is None:
+            try:
+                self._move_into_place(installation)
+            except Exception, e:
+                logging.exception('Error installing bundle %r',
+                                  installation.bundle.get_path())
+                installation.error = e
+
+        if installation.staging_path is not None:
+            shutil.rmtree(installation.staging_path, ignore_errors=True)
+        installation.finish()
+
+    def _move_into_place(self, installation):
+        # Other versions could have been installed in the meantime
+        installed_bundle = self._get_bundle_to_replace(
+            installation.bundle, installation.force_downgrade)
+        if installed_bundle is not None:
+            self.uninstall(installed_bundle, force=True)
+
+        install_path = os.path.join(env.get_user_activities_path(),
+                                    installation.bundle_dir)
+        if os.path.exists(install_path):
+            # Not a registered bundle, replace it like unzip would
+            os.rename(install_path, os.path.join(installation.staging_path,
+                                                 'old'))
+        os.rename(os.path.join(installation.staging_path,
+                               installation.bundle_dir), install_path)
+
+        # The MIME types link to the files of the bundle, so they can only
+        # be installed once it is in place
+        if not self.add_bundle(install_path, install_mime_type=True):
+            raise RegistrationException
+
     def uninstall(self, bundle, force=False, delete_profile=False):
         # TODO treat ContentBundle in special way
         # needs rethinking while fixing ContentBundle support
@@ -449,6 +721,167 @@ class BundleRegistry(GObject.GObject):
         self.install(bundle)
 
 
+class Installation(GObject.GObject):
+    """An installation of a bundle, see BundleRegistry.install_async()
+
+    Activity bundles are extracted by a worker thread into a staging
+    directory inside the user activities directory, which the registry
+    then moves into place, so a partly extracted bundle is never found
+    there. Only a few bundles are extracted at the same time.
+    """
+
+    __gsignals__ = {
+        'progress': (GObject.SignalFlags.RUN_FIRST, None,
+                     ([float])),
+        'extracted': (GObject.SignalFlags.RUN_FIRST, None,
+                      ([])),
+        'finished': (GObject.SignalFlags.RUN_FIRST, None,
+                     ([GObject.TYPE_PYOBJECT])),
+    }
+
+    def __init__(self, bundle, force_downgrade=False):
+        GObject.GObject.__init__(self)
+
+        self.bundle = bundle
+        self.force_downgrade = force_downgrade
+        self.staging_path = None
+        self.bundle_dir = None
+        self.error = None
+
+        # Updated by the worker thread
+        self._progress = 0.0
+        self._extracted = False
+
+        self._last_progress = 0.0
+        self._poll_hid = None
+
+    def start(self):
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+        self._poll_hid = GObject.timeout_add(_INSTALL_POLL_INTERVAL,
+                                             self.__poll_cb)
+
+    def finish(self):
+        self.emit('finished', self.error)
+        return False
+
+    def __poll_cb(self):
+        if self._progress != self._last_progress:
+            self._last_progress = self._progress
+            self.emit('progress', self._progress)
+
+        if self._extracted:
+            self._poll_hid = None
+            self.emit('extracted')
+            return False
+        return True
+
+    def _run(self):
+        _install_slots.acquire()
+        try:
+            self.staging_path = tempfile.mkdtemp(
+                prefix=_INSTALL_STAGING_PREFIX,
+                dir=env.get_user_activities_path())
+            self._extract()
+        except Exception, e:
+            logging.exception('Error extracting bundle %r',
+                              self.bundle.get_path())
+            self.error = e
+        finally:
+            _install_slots.release()
+            self._extracted = True
+
+    def _extract(self):
+        try:
+            zip_file = zipfile.ZipFile(self.bundle.get_path())
+        except (IOError, zipfile.BadZipfile):
+            raise ZipExtractException
+        try:
+            # Like the toolkit does, leave out the file with the MIME type
+            infos = [info for info in zip_file.infolist() \
+                         if info.filename != 'mimetype']
+            total_size = sum([info.file_size for info in infos]) or 1
+            extracted_size = 0
+
+            for info in infos:
+                path = os.path.normpath(os.path.join(self.staging_path,
+                                                     info.filename))
+                if not path.startswith(self.staging_path + os.sep):
+                    raise ZipExtractException
+
+                bundle_dir = path[len(self.staging_path) + 1:].split(os.sep)[0]
+                if self.bundle_dir is None:
+                    self.bundle_dir = bundle_dir
+                elif bundle_dir != self.bundle_dir:
+                    raise MalformedBundleException(
+                        'All files in the bundle must be inside a single '
+                        'directory')
+
+                if info.filename.endswith('/'):
+                    if not os.path.isdir(path):
+                        os.makedirs(path)
+                    continue
+
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                # Links extracted before could point elsewhere in the bundle
+                if not self._is_in_staging(os.path.dirname(path)):
+                    raise ZipExtractException
+
+                if stat.S_ISLNK(info.external_attr >> 16):
+                    self._extract_link(zip_file, info, path)
+                    continue
+
+                source = zip_file.open(info)
+                try:
+                    target = open(path, 'wb')
+                    try:
+                        while True:
+                            data = source.read(_INSTALL_BUFFER_SIZE)
+                            if not data:
+                                break
+                            target.write(data)
+                            extracted_size += len(data)
+                            self._progress = \
+                                    extracted_size / float(total_size)
+                    finally:
+                        target.close()
+                finally:
+                    source.close()
+
+                # Keep the permissions, scripts need to stay executable
+                mode = (info.external_attr >> 16) & 0777
+                if mode:
+                    os.chmod(path, mode)
+        except zipfile.BadZipfile:
+            raise ZipExtractException
+        finally:
+            zip_file.close()
+
+        if self.bundle_dir is None:
+            raise MalformedBundleException('Empty bundle')
+
+    def _is_in_staging(self, path):
+        staging_path = os.path.realpath(self.staging_path)
+        path = os.path.realpath(path)
+        return path == staging_path or \
+                path.startswith(staging_path + os.sep)
+
+    def _extract_link(self, zip_file, info, path):
+        """Create the symbolic link stored by info, like unzip does
+
+        The data of the entry is the target of the link, which must stay
+        inside the bundle.
+        """
+        link_target = zip_file.read(info)
+        target_path = os.path.join(os.path.realpath(os.path.dirname(path)),
+                                   link_target)
+        if not self._is_in_staging(os.path.normpath(target_path)):
+            raise ZipExtractException
+        os.symlink(link_target, path)
+
+
 def get_registry():
     global _instance
     if not _instance:
@@ -31,11 +31,25 @@ class MimeRegistry(object):
         # TODO move here all mime_type related code from jarabe modules
         self._gconf = GConf.Client.get_default()
 
+        # Default activities by GConf key, None if there is no default
+        self._defaults = {}
+        self._gconf.add_dir(_DEFAULTS_KEY,
+                            GConf.ClientPreloadType.PRELOAD_NONE)
+        self._gconf.notify_add(_DEFAULTS_KEY, self.__defaults_changed_cb, None)
+
+    def __defaults_changed_cb(self, client, cnxn_id, entry, *extra):
+        self._defaults.pop(entry.get_key(), None)
+
     def get_default_activity(self, mime_type):
-        return self._gconf.get_string(_key_name(mime_type))
+        key = _key_name(mime_type)
+        if key not in self._defaults:
+            self._defaults[key] = self._gconf.get_string(key)
+        return self._defaults[key]
 
     def set_default_activity(self, mime_type, bundle_id):
-        self._gconf.set_string(_key_name(mime_type), bundle_id)
+        key = _key_name(mime_type)
+        self._gconf.set_string(key, bundle_id)
+        self._defaults[key] = bundle_id
 
 
 def get_registry():
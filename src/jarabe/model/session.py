@@ -24,6 +24,8 @@ import logging
 from sugar3 import session
 from sugar3 import env
 
+from jarabe.model import bundleregistry
+
 
 _session_manager = None
 
@@ -54,6 +56,8 @@ class SessionManager(session.SessionManager):
         self.initiate_shutdown()
 
     def shutdown_completed(self):
+        bundleregistry.get_registry().flush()
+
         if env.is_emulator():
             self._close_emulator()
         elif self._logout_mode != self.MODE_LOGOUT:
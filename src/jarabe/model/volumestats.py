@@ -0,0 +1,150 @@
+# Copyright (C) 2012 One Laptop Per Child
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Free and total space of the profile and of the mounted volumes.
+
+The values are sampled with statvfs and kept, so the Journal, the volumes
+toolbar and the device icons in the frame all show the same numbers
+without asking the filesystem each time. The profile and the mounted
+volumes are sampled every _SAMPLE_INTERVAL seconds, so space used by
+other programs gets noticed too. Updates can also be requested as often
+as wanted, e.g. after every entry saved, but the volumes are sampled
+again at most once every _UPDATE_INTERVAL seconds.
+
+"""
+
+import logging
+import os
+import statvfs
+import time
+from collections import namedtuple
+
+from gi.repository import GObject
+from gi.repository import Gio
+
+from sugar3 import env
+
+
+# Minimum time, in seconds, between two samplings of the volumes
+_UPDATE_INTERVAL = 2
+# Time, in seconds, between two samplings nobody asked for
+_SAMPLE_INTERVAL = 30
+
+_model = None
+
+
+class Usage(namedtuple('Usage', ['free_space', 'total_space'])):
+    """Space on a volume, in bytes"""
+
+    __slots__ = ()
+
+    def get_used_fraction(self):
+        if not self.total_space:
+            return 0.0
+        return (self.total_space - self.free_space) / float(self.total_space)
+
+
+class VolumeStatsModel(GObject.GObject):
+    __gtype_name__ = 'SugarVolumeStatsModel'
+
+    __gsignals__ = {
+        'usage-changed': (GObject.SignalFlags.RUN_FIRST, None,
+                          ([str])),
+    }
+
+    def __init__(self):
+        GObject.GObject.__init__(self)
+
+        self._usage = {}
+        self._last_update = 0
+        self._update_hid = None
+
+        self._sample(env.get_profile_path())
+
+        volume_monitor = Gio.VolumeMonitor.get()
+        volume_monitor.connect('mount-added', self.__mount_added_cb)
+        volume_monitor.connect('mount-removed', self.__mount_removed_cb)
+        for mount in volume_monitor.get_mounts():
+            self.__mount_added_cb(volume_monitor, mount)
+
+        GObject.timeout_add_seconds(_SAMPLE_INTERVAL, self.__sample_cb)
+
+    def get_usage(self, path=None):
+        """Return the Usage of the volume path is in
+
+        By default the volume with the profile. Volumes not sampled yet
+        are sampled the first time they are asked about, after that the
+        last sampled value is returned. Returns None if the volume can't
+        be sampled.
+        """
+        if path is None:
+            path = env.get_profile_path()
+        if path not in self._usage:
+            self._sample(path)
+        return self._usage.get(path)
+
+    def queue_update(self):
+        """Sample the volumes again, once the interval passed"""
+        if self._update_hid is not None:
+            return
+
+        delay = self._last_update + _UPDATE_INTERVAL - time.time()
+        if delay > 0:
+            self._update_hid = GObject.timeout_add(int(delay * 1000),
+                                                   self.__update_cb)
+        else:
+            self._update_hid = GObject.idle_add(self.__update_cb)
+
+    def __sample_cb(self):
+        self.queue_update()
+        return True
+
+    def __update_cb(self):
+        self._update_hid = None
+        self._last_update = time.time()
+        for path in self._usage.keys():
+            self._sample(path)
+        return False
+
+    def _sample(self, path):
+        try:
+            stat = os.statvfs(path)
+        except OSError, e:
+            logging.error('Could not get the usage of %r: %s', path, e)
+            self._usage.pop(path, None)
+            return
+
+        usage = Usage(stat[statvfs.F_BSIZE] * stat[statvfs.F_BAVAIL],
+                      stat[statvfs.F_BSIZE] * stat[statvfs.F_BLOCKS])
+        old_usage = self._usage.get(path)
+        self._usage[path] = usage
+        if old_usage is not None and usage != old_usage:
+            self.emit('usage-changed', path)
+
+    def __mount_added_cb(self, volume_monitor, mount):
+        path = mount.get_root().get_path()
+        if path is not None:
+            self._sample(path)
+
+    def __mount_removed_cb(self, volume_monitor, mount):
+        self._usage.pop(mount.get_root().get_path(), None)
+
+
+def get_model():
+    global _model
+    if _model is None:
+        _model = VolumeStatsModel()
+    return _model
@@ -14,8 +14,6 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
-import os
-import statvfs
 from gettext import gettext as _
 import logging
 
@@ -36,6 +34,7 @@ from sugar3.graphics.xocolor import XoColor
 from sugar3.activity.i18n import pgettext
 
 from jarabe.model import shell
+from jarabe.model import volumestats
 from jarabe.view.viewsource import setup_view_source
 from jarabe.journal import misc
 
@@ -167,11 +166,61 @@ class ActivityPalette(Palette):
         misc.launch(self._activity_info)
 
 
+class FreeSpaceBox(Gtk.VBox):
+    """Shows how full the volume path is in, by default the profile's
+
+    The values are kept up to date while palette is popped up.
+    """
+
+    def __init__(self, palette, path=None):
+        Gtk.VBox.__init__(self)
+        self.set_spacing(style.DEFAULT_PADDING)
+
+        if path is None:
+            path = env.get_profile_path()
+        self._path = path
+
+        self._progress_bar = Gtk.ProgressBar()
+        self.pack_start(self._progress_bar, True, True, 0)
+        self._progress_bar.show()
+
+        self._free_space_label = Gtk.Label()
+        self._free_space_label.set_alignment(0.5, 0.5)
+        self.pack_start(self._free_space_label, True, True, 0)
+        self._free_space_label.show()
+
+        self._usage_changed_hid = None
+        palette.connect('popup', self.__popup_cb)
+        palette.connect('popdown', self.__popdown_cb)
+
+    def __popup_cb(self, palette):
+        stats = volumestats.get_model()
+        self._update_usage()
+        self._usage_changed_hid = stats.connect('usage-changed',
+                                                self.__usage_changed_cb)
+        stats.queue_update()
+
+    def __popdown_cb(self, palette):
+        if self._usage_changed_hid is not None:
+            volumestats.get_model().disconnect(self._usage_changed_hid)
+            self._usage_changed_hid = None
+
+    def __usage_changed_cb(self, stats, path):
+        if path == self._path:
+            self._update_usage()
+
+    def _update_usage(self):
+        usage = volumestats.get_model().get_usage(self._path)
+        if usage is None:
+            return
+        self._progress_bar.props.fraction = usage.get_used_fraction()
+        self._free_space_label.props.label = _('%(free_space)d MB Free') % \
+                {'free_space': usage.free_space / (1024 * 1024)}
+
+
 class JournalPalette(BasePalette):
     def __init__(self, home_activity):
         self._home_activity = home_activity
-        self._progress_bar = None
-        self._free_space_label = None
 
         BasePalette.__init__(self, home_activity)
 
@@ -198,35 +247,13 @@ class JournalPalette(BasePalette):
         box.append_item(separator)
         separator.show()
 
-        inner_box = Gtk.VBox()
-        inner_box.set_spacing(style.DEFAULT_PADDING)
-        box.append_item(inner_box, vertical_padding=0)
-        inner_box.show()
-
-        self._progress_bar = Gtk.ProgressBar()
-        inner_box.add(self._progress_bar)
-        self._progress_bar.show()
-
-        self._free_space_label = Gtk.Label()
-        self._free_space_label.set_alignment(0.5, 0.5)
-        inner_box.add(self._free_space_label)
-        self._free_space_label.show()
-
-        self.connect('popup', self.__popup_cb)
+        free_space_box = FreeSpaceBox(self)
+        box.append_item(free_space_box, vertical_padding=0)
+        free_space_box.show()
 
     def __open_activate_cb(self, menu_item):
         self._home_activity.get_window().activate(Gtk.get_current_event_time())
 
-    def __popup_cb(self, palette):
-        stat = os.statvfs(env.get_profile_path())
-        free_space = stat[statvfs.F_BSIZE] * stat[statvfs.F_BAVAIL]
-        total_space = stat[statvfs.F_BSIZE] * stat[statvfs.F_BLOCKS]
-
-        fraction = (total_space - free_space) / float(total_space)
-        self._progress_bar.props.fraction = fraction
-        self._free_space_label.props.label = _('%(free_space)d MB Free') % \
-                {'free_space': free_space / (1024 * 1024)}
-
 
 class VolumePalette(Palette):
     def __init__(self, mount):
@@ -254,22 +281,10 @@ class VolumePalette(Palette):
         self.content_box.append_item(separator)
         separator.show()
 
-        free_space_box = Gtk.VBox()
-        free_space_box.set_spacing(style.DEFAULT_PADDING)
+        free_space_box = FreeSpaceBox(self, path)
         self.content_box.append_item(free_space_box, vertical_padding=0)
         free_space_box.show()
 
-        self._progress_bar = Gtk.ProgressBar()
-        free_space_box.pack_start(self._progress_bar, True, True, 0)
-        self._progress_bar.show()
-
-        self._free_space_label = Gtk.Label()
-        self._free_space_label.set_alignment(0.5, 0.5)
-        free_space_box.pack_start(self._free_space_label, True, True, 0)
-        self._free_space_label.show()
-
-        self.connect('popup', self.__popup_cb)
-
     def __unmount_activate_cb(self, menu_item):
         self.popdown(immediate=True)
         flags = 0
@@ -284,13 +299,3 @@ class VolumePalette(Palette):
         logging.debug('__unmount_cb %r %r', mount, result)
         mount.unmount_with_operation_finish(result)
 
-    def __popup_cb(self, palette):
-        mount_point = self._mount.get_root().get_path()
-        stat = os.statvfs(mount_point)
-        free_space = stat[statvfs.F_BSIZE] * stat[statvfs.F_BAVAIL]
-        total_space = stat[statvfs.F_BSIZE] * stat[statvfs.F_BLOCKS]
-
-        fraction = (total_space - free_space) / float(total_space)
-        self._progress_bar.props.fraction = fraction
-        self._free_space_label.props.label = _('%(free_space)d MB Free') % \
-                {'free_space': free_space / (1024 * 1024)}